@@ -8,16 +8,33 @@ Unauthorized copying, transfer, or use is strictly prohibited.
 Violators will be prosecuted to the full extent of the law.
 For licensing information, please contact: alonbril5@gmail.com
 """
-from flask import Flask, render_template, request, redirect, url_for, flash, g, session, send_from_directory, jsonify
-from database import init_db, get_db, close_db, get_db_path, verify_database_structure
-from datetime import datetime, date, timedelta
-import pandas as pd
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+from flask import Flask, render_template, request, redirect, url_for, flash, g, session, jsonify, abort, Response, \
+    send_file, stream_with_context
+from database import init_db, get_db, close_db, get_db_path, store_signature, search_index_available, \
+    repair_inventory_status, normalize_borrower_name, get_borrower_id, archive_returned_loans, \
+    SIGNATURE_MIME_TYPES, get_schema_version, get_latest_schema_version, find_duplicate_green_numbers, \
+    has_unique_green_numbers
+from importer import run_import_job
+from jobs import job_queue, get_job, job_to_dict
+from exporter import EXPORTS, stream_csv, build_xlsx, get_import_template
+from assets import assets
+from cache import cache
+from responses import compress_response, conditional_page
+from policies import DEFAULT_CATEGORY, load_policies, policy_for, save_policy, delete_policy
+from datetime import datetime, date, timedelta, timezone
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import is_resource_modified
 
+import io
 import os
+import re
 import sys
+import json
+import uuid
+import base64
+import binascii
+import hashlib
 import logging
 
 
@@ -43,18 +60,23 @@ app = Flask(__name__,
             static_folder=resource_path('static'))
 
 app.secret_key = 'dev'
+job_queue.init_app(app)
+assets.init_app(app)
+app.after_request(compress_response)
+
 @app.context_processor
 def inject_year():
     return {'now': datetime.now()}
 
 # Configure upload folder
 UPLOAD_FOLDER = resource_path('uploads')
-ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
+ALLOWED_EXTENSIONS = {'xlsx', 'xls', 'csv'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['TEMPLATES_AUTO_RELOAD'] = True
-app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Templates reload and static files revalidate only in debug mode (Flask's defaults);
+# otherwise static files go through the fingerprinted asset URLs
+app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024  # 1GB max file size, imports are streamed from disk
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)
+app.config['ARCHIVE_AFTER_DAYS'] = 365  # returned loans older than this move to the archive database
 
 # Ensure upload folder exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -68,16 +90,22 @@ def get_pagination_params():
     return page, per_page, offset
 
 
-def get_sort_params():
-    """Get sorting parameters from request"""
+def get_sort_params(date_field='created_at'):
+    """
+    Get sorting parameters from request
+
+    Args:
+        date_field: Column behind sort_by=date, created_at for inventory items
+            and loan_date for loans
+    """
     sort_by = request.args.get('sort_by', 'id')
     sort_order = request.args.get('sort_order', 'desc')
 
-    # Validate sort parameters
+    # Validate sort parameters, the result is used as a column name and cursor key
     allowed_sort_fields = {
         'id': 'id',
         'green_number': 'green_number',
-        'date': 'created_at'  # for inventory items
+        'date': date_field
     }
 
     if sort_by not in allowed_sort_fields:
@@ -88,6 +116,104 @@ def get_sort_params():
 
     return sort_field, sort_direction
 
+
+def encode_cursor(sort_field, sort_direction, row):
+    """Encode the (sort value, id) of a row as an opaque pagination token"""
+    payload = json.dumps([sort_field, sort_direction, row[sort_field], row['id']])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, sort_field, sort_direction):
+    """Decode a pagination token, ignoring tokens issued for a different sort order"""
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, binascii.Error):
+        return None
+    if not isinstance(values, list) or len(values) != 4 or values[:2] != [sort_field, sort_direction]:
+        return None
+    return values[2], values[3]
+
+
+def get_keyset_page(cursor, source, where_clause, params, sort_field, sort_direction, per_page, columns='*'):
+    """
+    Fetch one page ordered by (sort_field, id), continuing from the request's cursor
+
+    The 'after' and 'before' tokens hold the last/first row of the neighbouring page,
+    so every page is a single index range scan no matter how deep it is.
+
+    Returns:
+        tuple: (rows, prev_cursor, next_cursor)
+    """
+    after = decode_cursor(request.args.get('after'), sort_field, sort_direction)
+    before = None if after else decode_cursor(request.args.get('before'), sort_field, sort_direction)
+
+    descending = sort_direction == 'DESC'
+    conditions = [where_clause] if where_clause else []
+    params = list(params)
+    order = sort_direction
+
+    if after:
+        conditions.append(f"({sort_field}, id) {'<' if descending else '>'} (?, ?)")
+        params += after
+    elif before:
+        # Walk backwards from the first row of the next page, then flip the result
+        conditions.append(f"({sort_field}, id) {'>' if descending else '<'} (?, ?)")
+        params += before
+        order = 'ASC' if descending else 'DESC'
+
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+    cursor.execute(f'''
+        SELECT {columns} FROM {source}
+        {where}
+        ORDER BY {sort_field} {order}, id {order}
+        LIMIT ?
+    ''', params + [per_page + 1])
+
+    rows = [dict(row) for row in cursor.fetchall()]
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before:
+        rows.reverse()
+
+    prev_cursor = next_cursor = None
+    if rows:
+        if after or (before and has_more):
+            prev_cursor = encode_cursor(sort_field, sort_direction, rows[0])
+        if before or has_more:
+            next_cursor = encode_cursor(sort_field, sort_direction, rows[-1])
+
+    return rows, prev_cursor, next_cursor
+
+
+COUNT_CACHE_SECONDS = 60
+
+
+def get_approximate_count(cursor, key, tables, query, params=()):
+    """Return a COUNT(*) result cached until one of its tables changes instead of recounting per request"""
+    def load():
+        cursor.execute(query, params)
+        return cursor.fetchone()[0]
+    return cache.get(('count', key), tables, load, ttl=COUNT_CACHE_SECONDS)
+
+
+def get_search_match(search_query):
+    """Build an FTS5 MATCH expression that prefix-matches every search term"""
+    if not search_query or not search_index_available():
+        return None
+    terms = re.findall(r'\w+', search_query)
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def get_prefix_range(prefix):
+    """Bounds for `column >= ? AND column < ?` matching every value that starts with prefix, using an index"""
+    return [prefix, prefix + '\U0010ffff']
+
+
 @app.template_filter('max')
 def max_filter(a, b):
     return max(a, b)
@@ -100,6 +226,8 @@ def min_filter(a, b):
 # Error handling
 @app.errorhandler(Exception)
 def handle_error(e):
+    if isinstance(e, HTTPException):
+        return e
     logger.error(f"Unhandled error: {str(e)}", exc_info=True)
     return render_template('error.html', error=str(e)), 500
 
@@ -118,15 +246,42 @@ def init_app():
     """Initialize the application"""
     try:
         with app.app_context():
-            verify_database_structure()
             init_db()
-            sync_inventory_status()
+            # Jobs use the latest schema, never start them against a partly migrated database
+            version = get_schema_version(get_db())
+            if version < get_latest_schema_version():
+                raise RuntimeError(f'Database is at schema version {version}, '
+                                   f'expected {get_latest_schema_version()}')
+            job_queue.recover_interrupted()
+            job_queue.enqueue('build_template')
+            job_queue.enqueue('archive_loans')
     except Exception as e:
         logger.error(f"Initialization error: {str(e)}", exc_info=True)
         raise
 
 
+def get_duplicate_green_numbers():
+    """Green numbers shared by several items, which keep imports disabled until someone resolves them"""
+    def load():
+        cursor = get_db().cursor()
+        if has_unique_green_numbers(cursor):
+            return []
+        return [dict(row) for row in find_duplicate_green_numbers(cursor)]
+    return cache.get('duplicate_green_numbers', ('inventory',), load)
+
+
+def get_overdue_green_numbers(cursor, green_numbers):
+    """Return which of the given green numbers have an active loan past its due date"""
+    cursor.execute('''
+        SELECT DISTINCT green_number FROM loans
+        WHERE status = 'active' AND due_date < date('now')
+        AND green_number IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(green_numbers),))
+    return {row['green_number'] for row in cursor.fetchall()}
+
+
 @app.route('/')
+@conditional_page('inventory', 'loans')
 def index():
     db = get_db()
     cursor = db.cursor()
@@ -138,32 +293,11 @@ def index():
     # Get search query from URL parameters
     search_query = request.args.get('search', '').strip()
 
-    # First, get the overdue loan green numbers
-    cursor.execute('''
-        SELECT DISTINCT l.green_number 
-        FROM loans l 
-        WHERE l.status = 'active' 
-        AND CAST((JULIANDAY('now') - JULIANDAY(l.loan_date)) AS INTEGER) > 7
-    ''')
-    overdue_items = cursor.fetchall()
-    overdue_green_numbers = set(str(item['green_number']) for item in overdue_items)
-
-    # Base query for counting total items
-    count_query = 'SELECT COUNT(*) as total FROM inventory'
-
-    # Base query for fetching items
-    item_query = '''
-        SELECT * FROM inventory
-        {where_clause}
-        ORDER BY {sort_field} {sort_direction}
-        LIMIT ? OFFSET ?
-    '''
-
-    # Add search conditions if search_query exists
-    where_clause = ''
-    query_params = []
+    prev_cursor = next_cursor = None
+    total_pages = None
 
     if search_query:
+        # Search results are bounded and ranked, so they keep numbered pages
         where_clause = '''
             WHERE name LIKE ? 
             OR green_number LIKE ? 
@@ -171,35 +305,59 @@ def index():
             OR status LIKE ?
         '''
         query_params = [f'%{search_query}%'] * 4
+        count_query = 'SELECT COUNT(*) as total FROM inventory'
+        item_query = '''
+            SELECT inventory.* FROM inventory
+            {where_clause}
+            ORDER BY {sort_field} {sort_direction}
+            LIMIT ? OFFSET ?
+        '''
+
+        search_match = get_search_match(search_query)
+        if search_match:
+            # Indexed prefix search, best matches first
+            where_clause = 'WHERE inventory_fts MATCH ?'
+            query_params = [search_match]
+            count_query = 'SELECT COUNT(*) as total FROM inventory_fts'
+            item_query = '''
+                SELECT inventory.* FROM inventory_fts
+                JOIN inventory ON inventory.id = inventory_fts.rowid
+                {where_clause}
+                ORDER BY inventory_fts.rank, inventory.{sort_field} {sort_direction}
+                LIMIT ? OFFSET ?
+            '''
 
-    # Get total count
-    if search_query:
         cursor.execute(count_query + ' ' + where_clause, query_params)
+        total_items = cursor.fetchone()['total']
+        total_pages = (total_items + per_page - 1) // per_page
+
+        query = item_query.format(
+            where_clause=where_clause,
+            sort_field=sort_field,
+            sort_direction=sort_direction
+        )
+        cursor.execute(query, query_params + [per_page, offset])
+        items = [dict(row) for row in cursor.fetchall()]
     else:
-        cursor.execute(count_query)
+        # Plain browsing pages by cursor, so deep pages cost the same as the first
+        items, prev_cursor, next_cursor = get_keyset_page(
+            cursor, 'inventory', '', [], sort_field, sort_direction, per_page)
+        total_items = get_approximate_count(cursor, 'inventory', ('inventory',), 'SELECT COUNT(*) FROM inventory')
 
-    total_items = cursor.fetchone()['total']
-    total_pages = (total_items + per_page - 1) // per_page
-
-    # Get items for current page
-    query = item_query.format(
-        where_clause=where_clause,
-        sort_field=sort_field,
-        sort_direction=sort_direction
-    )
-
-    cursor.execute(query, query_params + [per_page, offset])
-    items = [dict(row) for row in cursor.fetchall()]
-
-    # Add is_overdue flag to each item
+    # Flag overdue loans for the visible rows only
+    overdue_green_numbers = get_overdue_green_numbers(cursor, [item['green_number'] for item in items])
     for item in items:
-        item['is_overdue'] = str(item['green_number']) in overdue_green_numbers
+        item['is_overdue'] = item['green_number'] in overdue_green_numbers
 
     return render_template('index.html',
                            items=items,
                            search_query=search_query,
                            current_page=page,
                            total_pages=total_pages,
+                           prev_cursor=prev_cursor,
+                           next_cursor=next_cursor,
+                           total_items=total_items,
+                           duplicate_green_numbers=get_duplicate_green_numbers(),
                            sort_by=request.args.get('sort_by', 'id'),
                            sort_order=request.args.get('sort_order', 'desc'))
 
@@ -221,6 +379,7 @@ def add_item():
                 (name, quantity, green_number, category, status)
             )
             db.commit()
+            cache.bump('inventory')
             flash('Item added successfully!', 'success')
         except Exception as e:
             flash(f'Error adding item: {str(e)}', 'error')
@@ -249,6 +408,7 @@ def edit_item(id):
                 WHERE id = ?
             ''', (name, quantity, green_number, category, status, id))
             db.commit()
+            cache.bump('inventory')
             flash('Item updated successfully!', 'success')
             return redirect(url_for('index'))
         except Exception as e:
@@ -260,27 +420,91 @@ def edit_item(id):
     return render_template('edit.html', item=item)
 
 
+def get_loan_filters():
+    """
+    Build the WHERE clause for the active loans view from the request's filters
+
+    Returns:
+        tuple: (filters for the template, where clause, params)
+    """
+    filters = {
+        'borrower': request.args.get('borrower', '').strip(),
+        'overdue': request.args.get('overdue') == '1',
+        'date_from': request.args.get('date_from', '').strip(),
+        'date_to': request.args.get('date_to', '').strip(),
+    }
+    conditions = ["status = 'active'"]
+    params = []
+
+    if filters['borrower']:
+        # Prefix range on the unique borrower key index
+        conditions.append('borrower_id IN (SELECT id FROM borrowers WHERE name_key >= ? AND name_key < ?)')
+        params += get_prefix_range(normalize_borrower_name(filters['borrower']))
+    if filters['overdue']:
+        conditions.append("due_date < date('now')")
+
+    for key, operator in (('date_from', '>='), ('date_to', '<=')):
+        if not filters[key]:
+            continue
+        try:
+            params.append(date.fromisoformat(filters[key]).isoformat())
+        except ValueError:
+            flash(f'Invalid date {filters[key]}, the filter was ignored', 'error')
+            filters[key] = ''
+            continue
+        conditions.append(f'loan_date {operator} ?')
+
+    return filters, 'WHERE ' + ' AND '.join(conditions), params
+
+
 @app.route('/loans')
+@conditional_page('loans')
 def loans():
     db = get_db()
     cursor = db.cursor()
 
-    # Get all active loans with calculated days active
-    cursor.execute('''
-        SELECT *, 
-        CAST((JULIANDAY('now') - JULIANDAY(loan_date)) AS INTEGER) as days_active 
-        FROM loans 
-        WHERE status = 'active' 
-        ORDER BY borrower_name, loan_date DESC
-    ''')
+    page, per_page, offset = get_pagination_params()
+    filters, where_clause, params = get_loan_filters()
 
+    cursor.execute(f'SELECT COUNT(*) as total FROM loans {where_clause}', params)
+    total_items = cursor.fetchone()['total']
+    total_pages = (total_items + per_page - 1) // per_page
+
+    # Only the columns the page shows, one page at a time
+    cursor.execute(f'''
+        SELECT loans.id, borrower_id, borrowers.name as borrower_name, item_name, green_number, loan_date,
+        signature_hash, status,
+        CAST((JULIANDAY('now') - JULIANDAY(loan_date)) AS INTEGER) as days_active,
+        due_date < date('now') as is_overdue
+        -- Borrowers first: walking the name index and each borrower's active loans
+        -- index yields rows already in page order, without sorting every active loan
+        FROM borrowers 
+        CROSS JOIN loans ON loans.borrower_id = borrowers.id
+        {where_clause}
+        ORDER BY borrowers.name_key, loan_date DESC, loans.id DESC
+        LIMIT ? OFFSET ?
+    ''', params + [per_page, offset])
     loans = [dict(loan) for loan in cursor.fetchall()]
 
-    # Add is_overdue flag to each loan
-    for loan in loans:
-        loan['is_overdue'] = loan['days_active'] > 7
+    # Per-borrower totals for the borrowers on this page, a group may continue on the next one
+    borrower_ids = list(dict.fromkeys(loan['borrower_id'] for loan in loans))
+    cursor.execute(f'''
+        SELECT borrowers.name as borrower_name, COUNT(*) as loan_count,
+        SUM(due_date < date('now')) as overdue_count
+        FROM loans 
+        JOIN borrowers ON borrowers.id = loans.borrower_id
+        {where_clause} AND borrower_id IN (SELECT value FROM json_each(?))
+        GROUP BY borrower_id
+    ''', params + [json.dumps(borrower_ids)])
+    borrower_counts = {row['borrower_name']: dict(row) for row in cursor.fetchall()}
 
-    return render_template('loans.html', loans=loans)
+    return render_template('loans.html',
+                           loans=loans,
+                           borrower_counts=borrower_counts,
+                           filters=filters,
+                           current_page=page,
+                           total_pages=total_pages,
+                           total_items=total_items)
 
 
 @app.route('/add_loan', methods=['GET', 'POST'])
@@ -302,68 +526,28 @@ def add_loan():
                     flash('Signature is required!', 'error')
                     return render_template('add_loan.html',
                                          form_data=request.form,
-                                         available_items=get_available_items(),
+                                         selected_items=get_items_by_green_number(cursor, green_numbers),
                                          cart_templates=get_cart_templates())
 
                 if not green_numbers or not any(green_numbers):
                     flash('Please select at least one item!', 'error')
                     return render_template('add_loan.html',
                                          form_data=request.form,
-                                         available_items=get_available_items(),
+                                         selected_items=get_items_by_green_number(cursor, green_numbers),
                                          cart_templates=get_cart_templates())
 
-                # Start a transaction
-                cursor.execute('BEGIN TRANSACTION')
-
-                # Process each green number as a separate loan
-                for green_number in green_numbers:
-                    if not green_number:  # Skip empty selections
-                        continue
-
-                    # Check if green number exists and is available
-                    cursor.execute('SELECT * FROM inventory WHERE green_number = ?', (green_number,))
-                    inventory_item = cursor.fetchone()
-
-                    if inventory_item is None:
-                        raise Exception(f'Green number {green_number} does not exist in inventory!')
-
-                    cursor.execute('''
-                        SELECT * FROM loans 
-                        WHERE green_number = ? 
-                        AND status = 'active'
-                    ''', (green_number,))
-                    existing_loan = cursor.fetchone()
-
-                    if existing_loan:
-                        raise Exception(f'Green number {green_number} is currently on loan!')
-
-                    # Create the loan record
-                    cursor.execute('''
-                        INSERT INTO loans 
-                        (borrower_name, item_name, green_number, loan_date, signature, status) 
-                        VALUES (?, ?, ?, ?, ?, 'active')
-                    ''', (borrower_name, inventory_item['name'], green_number, loan_date, signature))
-
-                    # Update inventory item status to 'yes'
-                    cursor.execute('''
-                        UPDATE inventory
-                        SET status = 'yes'
-                        WHERE green_number = ?
-                    ''', (green_number,))
-
-                    loan_id = cursor.lastrowid
-
-                    # Add equipment for this loan
-                    for equip, qty in zip(equipment, equipment_quantities):
-                        if equip:  # Only process if equipment is selected
-                            cursor.execute('''
-                                INSERT INTO loans_equipment 
-                                (loan_id, equipment_type, quantity) 
-                                VALUES (?, ?, ?)
-                            ''', (loan_id, equip, qty))
+                # Take the write lock up front so the new loan ids are ours alone
+                cursor.execute('BEGIN IMMEDIATE')
+
+                # Store the signature once for the whole checkout
+                signature_hash = store_signature(cursor, signature)
+
+                create_loans(cursor, borrower_name, green_numbers, loan_date, signature_hash,
+                             [(equip, qty) for equip, qty in zip(equipment, equipment_quantities) if equip])
 
                 # Commit the transaction
                 cursor.execute('COMMIT')
+                cache.bump('loans')
                 flash('Loan(s) added successfully!', 'success')
                 return redirect(url_for('loans'))
 
@@ -373,73 +557,163 @@ def add_loan():
                 flash(f'Error adding loan: {str(e)}', 'error')
                 return render_template('add_loan.html',
                                      form_data=request.form,
-                                     available_items=get_available_items(),
+                                     selected_items=get_items_by_green_number(
+                                         cursor, request.form.getlist('green_numbers[]')),
                                      cart_templates=get_cart_templates())
 
         # For GET requests
         return render_template('add_loan.html',
-                             available_items=get_available_items(),
+                             selected_items=[],
                              cart_templates=get_cart_templates())
 
     except Exception as e:
         flash(f'Error: {str(e)}', 'error')
         return redirect(url_for('loans'))
 
-# Add this helper function if not already present
+def create_loans(cursor, borrower_name, green_numbers, loan_date, signature_hash, equipment):
+    """
+    Check out a whole cart in a constant number of queries
+
+    The cart is validated with one query for existence and one for active
+    loans, and every problem is reported together. Must run inside a write
+    transaction (BEGIN IMMEDIATE) so the ids allocated here are not shared.
+
+    Args:
+        green_numbers: Green numbers from the form, blanks are ignored
+        equipment: List of (equipment type, quantity) added to every loan
+
+    Raises:
+        ValueError: listing every problem with the loan date and green numbers
+    """
+    numbers = []
+    problems = []
+    # An unparseable date would make SQLite store a NULL due date, and the loan could never be overdue
+    try:
+        loan_date = datetime.strptime(loan_date, '%Y-%m-%d').date().isoformat()
+    except (TypeError, ValueError):
+        problems.append(f'Loan date {loan_date} is not a valid date (YYYY-MM-DD)')
+
+    for green_number in green_numbers:
+        if not green_number:  # Skip empty selections
+            continue
+        try:
+            number = int(green_number)
+        except ValueError:
+            problems.append(f'Green number {green_number} is not a number')
+            continue
+        if number in numbers:
+            problems.append(f'Green number {number} is in the cart more than once')
+            continue
+        numbers.append(number)
+
+    cart = json.dumps(numbers)
+    cursor.execute('''
+        SELECT green_number, name, category FROM inventory
+        WHERE green_number IN (SELECT value FROM json_each(?))
+    ''', (cart,))
+    items = {row['green_number']: row for row in cursor.fetchall()}
+
+    cursor.execute('''
+        SELECT DISTINCT green_number FROM loans
+        WHERE status = 'active' AND green_number IN (SELECT value FROM json_each(?))
+    ''', (cart,))
+    on_loan = {row['green_number'] for row in cursor.fetchall()}
+
+    for number in numbers:
+        if number not in items:
+            problems.append(f'Green number {number} does not exist in inventory')
+        elif number in on_loan:
+            problems.append(f'Green number {number} is currently on loan')
+
+    if problems:
+        raise ValueError('; '.join(problems))
+
+    # AUTOINCREMENT ids only grow, so every loan above this mark is from this checkout
+    cursor.execute('SELECT COALESCE(MAX(id), 0) FROM loans')
+    last_id = cursor.fetchone()[0]
+
+    borrower_name = ' '.join(borrower_name.split())
+    borrower_id = get_borrower_id(cursor, borrower_name)
+
+    # The due date is fixed by the item's category policy when the loan is written
+    rows = []
+    for number in numbers:
+        policy = policy_for(cursor.connection, items[number]['category'])
+        rows.append((borrower_name, borrower_id, items[number]['name'], number, loan_date,
+                     loan_date, f'+{policy.loan_days} days', signature_hash))
+
+    cursor.executemany('''
+        INSERT INTO loans 
+        (borrower_name, borrower_id, item_name, green_number, loan_date, due_date, signature_hash, status) 
+        VALUES (?, ?, ?, ?, ?, date(?, ?), ?, 'active')
+    ''', rows)
+
+    cursor.executemany('''
+        INSERT INTO loans_equipment (loan_id, equipment_type, quantity)
+        SELECT id, ?, ? FROM loans WHERE id > ?
+    ''', [(equip, qty, last_id) for equip, qty in equipment])
+
+    return len(numbers)
+
+
+# The dropdown lists below are served from the cache until their tables are bumped
 def get_cart_templates():
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute('SELECT id, name FROM cart_templates ORDER BY name')
+    def load():
+        cursor = get_db().cursor()
+        cursor.execute('SELECT id, name FROM cart_templates ORDER BY name')
+        return cursor.fetchall()
+    return cache.get('cart_templates', ('cart_templates',), load)
+
+
+def get_items_by_green_number(cursor, green_numbers):
+    """Inventory items (green_number, name) for the given green numbers, to show a form's current selection"""
+    numbers = [int(value) for value in green_numbers if str(value).isdigit()]
+    cursor.execute('''
+        SELECT green_number, name FROM inventory
+        WHERE green_number IN (SELECT value FROM json_each(?))
+        ORDER BY green_number
+    ''', (json.dumps(numbers),))
     return cursor.fetchall()
 
 
-def is_green_number_in_use(green_number, exclude_template_id=None):
+def find_template_conflicts(cursor, green_numbers, exclude_template_id=None):
     """
-    Check if a green number is already used in any other template
+    Find green numbers that already belong to another template, in one query
 
     Args:
-        green_number: The green number to check
-        exclude_template_id: Optional template ID to exclude from the check (used during editing)
+        green_numbers: The green numbers to check
+        exclude_template_id: Optional template ID to leave out of the check (used during editing)
 
     Returns:
-        bool: True if the green number is already in use, False otherwise
+        list: (green_number, template_name) for every conflict
     """
-    db = get_db()
-    cursor = db.cursor()
-
-    if exclude_template_id is not None:
-        cursor.execute('''
-            SELECT COUNT(*) as count 
-            FROM cart_template_items cti 
-            JOIN cart_templates ct ON cti.template_id = ct.id 
-            WHERE cti.green_number = ? AND ct.id != ?
-        ''', (green_number, exclude_template_id))
-    else:
-        cursor.execute('''
-            SELECT COUNT(*) as count 
-            FROM cart_template_items 
-            WHERE green_number = ?
-        ''', (green_number,))
+    cursor.execute('''
+        SELECT cti.green_number, ct.name
+        FROM cart_template_items cti
+        JOIN cart_templates ct ON cti.template_id = ct.id
+        WHERE cti.green_number IN (SELECT value FROM json_each(?))
+        AND cti.template_id IS NOT ?
+        ORDER BY cti.green_number
+    ''', (json.dumps(green_numbers), exclude_template_id))
+    return [(row['green_number'], row['name']) for row in cursor.fetchall()]
 
-    result = cursor.fetchone()
-    return result['count'] > 0
 
+def save_template_items(cursor, template_id, green_numbers):
+    """
+    Make a template hold exactly the given green numbers
 
-# Add this helper function to get available items
-def get_available_items():
-    db = get_db()
-    cursor = db.cursor()
+    Only the difference is written: removed items are deleted and added ones
+    inserted, so unchanged items (and the template's version) are left alone.
+    """
+    cursor.execute('SELECT green_number FROM cart_template_items WHERE template_id = ?', (template_id,))
+    current = {row['green_number'] for row in cursor.fetchall()}
+    selected = set(green_numbers)
 
-    # Get items that are either not loaned or have been returned
-    cursor.execute('''
-        SELECT DISTINCT i.green_number, i.name 
-        FROM inventory i
-        LEFT JOIN loans l ON i.green_number = l.green_number AND l.status = 'active'
-        WHERE l.id IS NULL
-        ORDER BY i.green_number
-    ''')
+    cursor.executemany('DELETE FROM cart_template_items WHERE template_id = ? AND green_number = ?',
+                       [(template_id, green_number) for green_number in current - selected])
+    cursor.executemany('INSERT INTO cart_template_items (template_id, green_number) VALUES (?, ?)',
+                       [(template_id, green_number) for green_number in green_numbers if green_number not in current])
 
-    return cursor.fetchall()
 
 def get_active_loans():
     db = get_db()
@@ -459,40 +733,11 @@ def return_loan(id):
         db = get_db()
         cursor = db.cursor()
 
-        # Start transaction
-        cursor.execute('BEGIN TRANSACTION')
-
-        # Get the green number before updating the loan
-        cursor.execute('SELECT green_number FROM loans WHERE id = ?', (id,))
-        loan = cursor.fetchone()
-
-        if loan:
-            # Update loan status to returned
-            cursor.execute('''
-                UPDATE loans 
-                SET status = 'returned', return_date = ?
-                WHERE id = ?
-            ''', (date.today().isoformat(), id))
-
-            # Check if this item has any other active loans
-            cursor.execute('''
-                SELECT COUNT(*) as active_count 
-                FROM loans 
-                WHERE green_number = ? AND status = 'active' AND id != ?
-            ''', (loan['green_number'], id))
-
-            active_count = cursor.fetchone()['active_count']
-
-            # If no other active loans, update inventory status to 'no'
-            if active_count == 0:
-                cursor.execute('''
-                    UPDATE inventory 
-                    SET status = 'no'
-                    WHERE green_number = ?
-                ''', (loan['green_number'],))
+        return_loans(cursor, [id])
 
         # Commit transaction
         db.commit()
+        cache.bump('loans')
         flash('Loan marked as returned!', 'success')
 
     except Exception as e:
@@ -501,24 +746,80 @@ def return_loan(id):
     return redirect(url_for('loans'))
 
 
-@app.route('/get_template_items/<int:template_id>')
-def get_template_items(template_id):
+def return_loans(cursor, loan_ids):
+    """
+    Mark loans returned in one statement, whatever the number of loans
+
+    Triggers put the items back to available once no active loan is left.
+
+    Returns:
+        int: number of loans that were returned
+    """
+    ids = json.dumps([int(loan_id) for loan_id in loan_ids])
+
+    cursor.execute('''
+        UPDATE loans 
+        SET status = 'returned', return_date = ?
+        WHERE status = 'active' AND id IN (SELECT value FROM json_each(?))
+    ''', (date.today().isoformat(), ids))
+    return cursor.rowcount
+
+
+@app.route('/api/template_items')
+def template_items():
+    """
+    Items of one or more cart templates with their availability, e.g. ?ids=3,7
+
+    The ETag is built from the templates' version counters, which triggers bump
+    on any change to the template, its items' names or their loan status, so a
+    revalidating browser gets a 304 without the items being read at all.
+    """
     try:
-        db = get_db()
-        cursor = db.cursor()
+        template_ids = list(dict.fromkeys(int(value) for value in request.args.get('ids', '').split(',') if value))
+    except ValueError:
+        return jsonify({'error': 'ids must be a comma separated list of template ids'}), 400
+
+    db = get_db()
+    cursor = db.cursor()
+    ids = json.dumps(template_ids)
 
-        # Get all items for the template
+    cursor.execute('''
+        SELECT id, version, COALESCE(updated_at, created_at) as updated_at
+        FROM cart_templates
+        WHERE id IN (SELECT value FROM json_each(?))
+    ''', (ids,))
+    versions = cursor.fetchall()
+    etag = hashlib.sha256(json.dumps(sorted((row['id'], row['version']) for row in versions)).encode()).hexdigest()[:32]
+    last_modified = max((datetime.strptime(row['updated_at'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+                         for row in versions), default=None)
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
         cursor.execute('''
-            SELECT cti.green_number, i.name 
-            FROM cart_template_items cti 
-            JOIN inventory i ON cti.green_number = i.green_number 
-            WHERE cti.template_id = ?
-        ''', (template_id,))
+            SELECT ct.id as template_id, ct.name as template_name, cti.green_number, i.name,
+                   i.status IS NOT 'yes' as available
+            FROM cart_templates ct
+            JOIN cart_template_items cti ON cti.template_id = ct.id
+            JOIN inventory i ON i.green_number = cti.green_number
+            WHERE ct.id IN (SELECT value FROM json_each(?))
+            ORDER BY ct.id, cti.green_number
+        ''', (ids,))
+
+        templates = {}
+        for row in cursor.fetchall():
+            template = templates.setdefault(row['template_id'], {
+                'id': row['template_id'], 'name': row['template_name'], 'items': []})
+            template['items'].append({
+                'green_number': row['green_number'], 'name': row['name'], 'available': bool(row['available'])})
+        response = jsonify([templates[template_id] for template_id in template_ids if template_id in templates])
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Cached, but checked with the server on every use
+    response.cache_control.no_cache = True
+    return response
 
-        items = cursor.fetchall()
-        return jsonify([dict(item) for item in items])
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
 
 @app.route('/delete/<int:id>')
 def delete_item(id):
@@ -527,6 +828,7 @@ def delete_item(id):
         cursor = db.cursor()
         cursor.execute('DELETE FROM inventory WHERE id = ?', (id,))
         db.commit()
+        cache.bump('inventory')
         flash('Item deleted successfully!', 'success')
     except Exception as e:
         flash(f'Error deleting item: {str(e)}', 'error')
@@ -535,48 +837,59 @@ def delete_item(id):
 
 
 @app.route('/loans_history')
+@conditional_page('loans')
 def loans_history():
     db = get_db()
     cursor = db.cursor()
 
     # Get pagination and sorting parameters
     page, per_page, offset = get_pagination_params()
-    sort_field, sort_direction = get_sort_params()
+    sort_field, sort_direction = get_sort_params('loan_date')
 
-    # Count total returned loans
-    cursor.execute('''
+    # Approximate count of returned loans, archived ones included
+    total_items = get_approximate_count(cursor, 'loans_history', ('loans',), '''
         SELECT COUNT(*) as total 
-        FROM loans 
+        FROM all_loans 
         WHERE status = 'returned'
     ''')
-    total_items = cursor.fetchone()['total']
-    total_pages = (total_items + per_page - 1) // per_page
 
     # Get loans for current page
-    cursor.execute('''
-        SELECT * FROM loans 
-        WHERE status = 'returned' 
-        ORDER BY {} {}
-        LIMIT ? OFFSET ?
-    '''.format(sort_field, sort_direction), [per_page, offset])
-
-    loans = cursor.fetchall()
+    loans, prev_cursor, next_cursor = get_keyset_page(
+        cursor, 'all_loans', "status = 'returned'", [], sort_field, sort_direction, per_page)
 
     return render_template('loans_history.html',
                            loans=loans,
-                           current_page=page,
-                           total_pages=total_pages,
+                           prev_cursor=prev_cursor,
+                           next_cursor=next_cursor,
+                           total_items=total_items,
                            sort_by=request.args.get('sort_by', 'id'),
                            sort_order=request.args.get('sort_order', 'desc'))
 
 
+@app.route('/export/<dataset>.<any(csv, xlsx):file_format>')
+def export_data(dataset, file_format):
+    if dataset not in EXPORTS:
+        abort(404)
+
+    filename = f'{dataset}-{date.today().isoformat()}.{file_format}'
+    db = get_db()
+
+    if file_format == 'csv':
+        # Rows are written to the response as they come off the cursor
+        response = Response(stream_with_context(stream_csv(db, dataset)), mimetype='text/csv')
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+        return response
+
+    return send_file(build_xlsx(db, dataset),
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                     as_attachment=True,
+                     download_name=filename)
+
 
 UPLOAD_FOLDER = 'uploads'
-ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
+ALLOWED_EXTENSIONS = {'xlsx', 'xls', 'csv'}
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['TEMPLATES_AUTO_RELOAD'] = True
-app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 app.config['SESSION_TYPE'] = 'filesystem'
 app.config['SESSION_PERMANENT'] = False
 
@@ -589,65 +902,12 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def create_excel_template():
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Inventory Template"
-
-    # Define headers
-    headers = ['name', 'quantity', 'green_number', 'category', 'status']
-    example_data = ['Example Item', 5, 1001, 'Electronics', 'no']
-
-    # Style definitions
-    header_font = Font(bold=True, color="FFFFFF")
-    header_fill = PatternFill(start_color="2196F3", end_color="2196F3", fill_type="solid")
-    border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-
-    # Apply headers and styling
-    for col, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col)
-        cell.value = header
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.border = border
-        cell.alignment = Alignment(horizontal='center')
-
-    # Add example row
-    for col, value in enumerate(example_data, 1):
-        cell = ws.cell(row=2, column=col)
-        cell.value = value
-        cell.border = border
-        cell.alignment = Alignment(horizontal='center')
-
-    # Set column widths
-    ws.column_dimensions['A'].width = 30  # name
-    ws.column_dimensions['B'].width = 10  # quantity
-    ws.column_dimensions['C'].width = 15  # green_number
-    ws.column_dimensions['D'].width = 20  # category
-    ws.column_dimensions['E'].width = 10  # status
-
-    # Create templates directory if it doesn't exist
-    template_dir = os.path.join(app.static_folder, 'templates')
-    os.makedirs(template_dir, exist_ok=True)
-
-    # Save template
-    template_path = os.path.join(template_dir, 'inventory_template.xlsx')
-    wb.save(template_path)
-    return template_path
-
-
-# Add this route for template download
 @app.route('/download_template')
 def download_template():
-    template_path = create_excel_template()
-    directory = os.path.dirname(template_path)
-    filename = os.path.basename(template_path)
-    return send_from_directory(directory, filename, as_attachment=True)
+    etag, data = get_import_template()
+    return send_file(io.BytesIO(data), as_attachment=True, download_name='inventory_template.xlsx',
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                     etag=etag, conditional=True, max_age=0)
 
 
 # Update your import_inventory route to include template creation
@@ -664,98 +924,110 @@ def import_inventory():
             return redirect(url_for('index'))
 
         if file and allowed_file(file.filename):
-            try:
-                # Read Excel file
-                df = pd.read_excel(file)
-
-                # Verify required columns
-                required_columns = {'name', 'quantity', 'green_number', 'category', 'status'}
-                if not required_columns.issubset(df.columns):
-                    flash('Excel file must contain columns: name, quantity, green_number, category, status', 'error')
-                    return redirect(url_for('index'))
-
-                # Process each row
-                db = get_db()
-                cursor = db.cursor()
-                success_count = 0
-                error_count = 0
-
-                for index, row in df.iterrows():
-                    try:
-                        # Check if item with green_number already exists
-                        cursor.execute('SELECT id FROM inventory WHERE green_number = ?', (row['green_number'],))
-                        existing_item = cursor.fetchone()
-
-                        if existing_item:
-                            # Update existing item
-                            cursor.execute('''
-                                UPDATE inventory 
-                                SET name = ?, quantity = ?, category = ?, status = ?
-                                WHERE green_number = ?
-                            ''', (row['name'], row['quantity'], row['category'],
-                                  row['status'], row['green_number']))
-                        else:
-                            # Insert new item
-                            cursor.execute('''
-                                INSERT INTO inventory (name, quantity, green_number, category, status)
-                                VALUES (?, ?, ?, ?, ?)
-                            ''', (row['name'], row['quantity'], row['green_number'],
-                                  row['category'], row['status']))
-                        success_count += 1
-                    except Exception as e:
-                        error_count += 1
-                        logger.error(f"Error processing row {index}: {str(e)}")
-                        continue
-
-                db.commit()
-                flash(f'Successfully imported {success_count} items. {error_count} errors.', 'success')
+            # Stream the upload to disk, then import it in chunks under a resumable job
+            extension = file.filename.rsplit('.', 1)[1].lower()
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{uuid.uuid4().hex}.{extension}')
+            file.save(file_path)
+
+            job_id = job_queue.enqueue('import_inventory',
+                                       filename=secure_filename(file.filename) or file.filename,
+                                       file_path=file_path)
+            flash('Import started, you can keep working while it runs.', 'success')
+            return redirect(url_for('job_status', job_id=job_id))
+
+        flash('Invalid file type. Please upload an Excel or CSV file (.xlsx, .xls or .csv)', 'error')
+        return redirect(url_for('index'))
 
-            except Exception as e:
-                flash(f'Error processing file: {str(e)}', 'error')
-                logger.error(f"Import error: {str(e)}")
+    return render_template('import_inventory.html')
 
-            return redirect(url_for('index'))
+@app.route('/import_inventory/resume/<job_id>', methods=['POST'])
+def resume_import(job_id):
+    if job_queue.resume(job_id):
+        flash('Import resumed.', 'success')
+    else:
+        flash('Only failed imports whose upload is still kept can be resumed, please import the file again.', 'error')
+    return redirect(url_for('job_status', job_id=job_id))
 
-        flash('Invalid file type. Please upload an Excel file (.xlsx or .xls)', 'error')
-        return redirect(url_for('index'))
 
-    # Create template on first access
-    template_path = os.path.join(app.static_folder, 'templates', 'inventory_template.xlsx')
-    if not os.path.exists(template_path):
-        create_excel_template()
+@job_queue.handler('import_inventory')
+def import_inventory_job(db, job):
+    try:
+        run_import_job(db, job)
+    finally:
+        # Chunks are committed as they go, so even a failed import may have added items
+        cache.bump('inventory')
 
-    return render_template('import_inventory.html')
 
-# Add this function at the end of your app.py, just before the if __name__ == '__main__': line
+@job_queue.handler('build_template', enqueue_from_web=True)
+def build_template_job(db, job):
+    etag, data = get_import_template()
+    return {'etag': etag, 'size': len(data)}
 
-def sync_inventory_status():
-    try:
-        db = get_db()
-        cursor = db.cursor()
 
-        # Start transaction
-        cursor.execute('BEGIN TRANSACTION')
+@job_queue.handler('archive_loans', enqueue_from_web=True)
+def archive_loans_job(db, job):
+    moved = archive_returned_loans(db, app.config['ARCHIVE_AFTER_DAYS'])
+    if moved:
+        cache.bump('loans')
+    return {'moved': moved}
 
-        # First, set all items to 'no'
-        cursor.execute('UPDATE inventory SET status = ?', ('no',))
 
-        # Then set items with active loans to 'yes'
-        cursor.execute('''
-            UPDATE inventory 
-            SET status = 'yes'
-            WHERE green_number IN (
-                SELECT DISTINCT green_number 
-                FROM loans 
-                WHERE status = 'active'
-            )
-        ''')
+@job_queue.handler('sync_inventory_status', enqueue_from_web=True)
+def sync_inventory_status_job(db, job):
+    return {'repaired': sync_inventory_status()}
+
+
+@app.route('/jobs/<kind>', methods=['POST'])
+def enqueue_job(kind):
+    if not job_queue.can_enqueue_from_web(kind):
+        abort(404)
+    job_id = job_queue.enqueue(kind)
+
+    if request.accept_mimetypes.accept_json and not request.accept_mimetypes.accept_html:
+        return jsonify({'id': job_id, 'status_url': url_for('job_progress', job_id=job_id)}), 202
+    return redirect(url_for('job_status', job_id=job_id))
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job(get_db(), job_id)
+    if job is None:
+        abort(404)
+    job = job_to_dict(job)
+    return render_template('job_status.html', job=job)
+
+
+@app.route('/api/jobs/<job_id>')
+def job_progress(job_id):
+    job = get_job(get_db(), job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_to_dict(job))
 
+
+@app.route('/api/jobs/<job_id>/result')
+def job_result(job_id):
+    job = get_job(get_db(), job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    result = job_to_dict(job)
+    result['errors'] = json.loads(job['errors'])
+    return jsonify(result)
+
+
+def sync_inventory_status():
+    """Repair inventory statuses that drifted from the loans, returning how many were fixed"""
+    db = get_db()
+    try:
+        repaired = repair_inventory_status(db.cursor())
         db.commit()
-        return True
-    except Exception as e:
+        cache.bump('inventory')
+    except Exception:
         db.rollback()
-        print(f"Error syncing inventory status: {str(e)}")
-        return False
+        raise
+    if repaired:
+        logger.warning(f"Repaired the status of {repaired} inventory items")
+    return repaired
 
 
 @app.route('/extend_loan/<int:id>')
@@ -764,24 +1036,33 @@ def extend_loan(id):
         db = get_db()
         cursor = db.cursor()
 
-        # Get current loan details
         cursor.execute('''
-            SELECT loan_date, 
-            CAST((JULIANDAY('now') - JULIANDAY(loan_date)) AS INTEGER) as days_active 
-            FROM loans 
-            WHERE id = ?
+            SELECT l.extensions, i.category
+            FROM loans l
+            LEFT JOIN inventory i ON i.green_number = l.green_number
+            WHERE l.id = ?
         ''', (id,))
         loan = cursor.fetchone()
+        if loan is None:
+            flash('Loan not found!', 'error')
+            return redirect(url_for('loans'))
 
-        if loan and loan['days_active'] > 7:
-            # Calculate new loan date (current loan date + 7 days)
-            cursor.execute('''
-                UPDATE loans 
-                SET loan_date = date(loan_date, '+7 days')
-                WHERE id = ?
-            ''', (id,))
-            db.commit()
-            flash('Loan extended for one week!', 'success')
+        policy = policy_for(db, loan['category'])
+        if policy.max_extensions is not None and loan['extensions'] >= policy.max_extensions:
+            flash('Loan has already been extended the maximum number of times!', 'error')
+            return redirect(url_for('loans'))
+
+        # Only overdue loans can be extended, by moving the due date
+        cursor.execute('''
+            UPDATE loans 
+            SET due_date = date(due_date, ?), extensions = extensions + 1
+            WHERE id = ? AND status = 'active' AND due_date < date('now')
+        ''', (f'+{policy.extension_days} days', id))
+        db.commit()
+        cache.bump('loans')
+
+        if cursor.rowcount:
+            flash(f'Loan extended by {policy.extension_days} days!', 'success')
         else:
             flash('Loan cannot be extended!', 'error')
 
@@ -803,8 +1084,9 @@ def loan_details(id):
         # Get loan details
         cursor.execute('''
             SELECT *, 
-            CAST((JULIANDAY('now') - JULIANDAY(loan_date)) AS INTEGER) as days_active 
-            FROM loans 
+            CAST((JULIANDAY('now') - JULIANDAY(loan_date)) AS INTEGER) as days_active,
+            due_date < date('now') as is_overdue
+            FROM all_loans 
             WHERE id = ?
         ''', (id,))
         loan = cursor.fetchone()
@@ -816,7 +1098,7 @@ def loan_details(id):
         # Get equipment details
         cursor.execute('''
             SELECT equipment_type, quantity 
-            FROM loans_equipment 
+            FROM all_loans_equipment 
             WHERE loan_id = ?
         ''', (id,))
         equipment = cursor.fetchall()
@@ -824,13 +1106,81 @@ def loan_details(id):
         return render_template('loan_details.html',
                                loan=loan,
                                equipment=equipment,
-                               days_active=loan['days_active'])
+                               days_active=loan['days_active'],
+                               is_overdue=loan['is_overdue'])
 
     except Exception as e:
         flash(f'Error loading loan details: {str(e)}', 'error')
         return redirect(url_for('loans'))
 
 
+@app.route('/loan_policies', methods=['GET', 'POST'])
+def loan_policies():
+    db = get_db()
+
+    if request.method == 'POST':
+        try:
+            category = request.form['category'].strip() or DEFAULT_CATEGORY
+            loan_days = int(request.form['loan_days'])
+            extension_days = int(request.form['extension_days'])
+            max_extensions = request.form.get('max_extensions', '').strip()
+            max_extensions = int(max_extensions) if max_extensions else None
+
+            if loan_days <= 0 or extension_days <= 0 or (max_extensions is not None and max_extensions < 0):
+                raise ValueError('Days must be positive and the extension limit 0 or more')
+
+            save_policy(db, category, loan_days, extension_days, max_extensions)
+            flash(f'Loan policy for {category} saved! It applies to new loans and extensions.', 'success')
+        except ValueError as e:
+            flash(f'Error saving loan policy: {str(e)}', 'error')
+        return redirect(url_for('loan_policies'))
+
+    cursor = db.cursor()
+    cursor.execute('SELECT DISTINCT category FROM inventory ORDER BY category')
+    categories = [row['category'] for row in cursor.fetchall()]
+
+    policies = sorted(load_policies(db).values(), key=lambda policy: (policy.category != DEFAULT_CATEGORY, policy.category))
+    return render_template('loan_policies.html',
+                           policies=policies,
+                           categories=categories,
+                           default_category=DEFAULT_CATEGORY)
+
+
+@app.route('/loan_policies/delete', methods=['POST'])
+def delete_loan_policy():
+    try:
+        delete_policy(get_db(), request.form['category'])
+        flash('Loan policy deleted, the category now uses the default policy.', 'success')
+    except ValueError as e:
+        flash(f'Error deleting loan policy: {str(e)}', 'error')
+    return redirect(url_for('loan_policies'))
+
+
+@app.route('/signature/<signature_hash>')
+def signature(signature_hash):
+    # Hashes are SHA-256 hex digests, reject anything else before touching the DB
+    if len(signature_hash) != 64 or any(c not in '0123456789abcdef' for c in signature_hash):
+        abort(404)
+
+    db = get_db()
+    cursor = db.cursor()
+    # Signatures of archived loans move to the archive with them
+    cursor.execute('SELECT mime_type, data FROM all_signatures WHERE hash = ?', (signature_hash,))
+    stored = cursor.fetchone()
+    # Rows stored before the type check may hold other types, never serve those
+    if stored is None or stored['mime_type'] not in SIGNATURE_MIME_TYPES:
+        abort(404)
+
+    # Content-addressed, so the image behind a hash can never change
+    response = Response(stored['data'], mimetype=stored['mime_type'])
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.set_etag(signature_hash)
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+
 @app.route('/back')
 def back_to_previous():
     previous_page = session.get('previous_page')
@@ -841,14 +1191,13 @@ def back_to_previous():
 # Optional: Add the route to manually trigger the sync
 @app.route('/sync_inventory_status')
 def sync_inventory():
-    if sync_inventory_status():
-        flash('Inventory status synchronized successfully!', 'success')
-    else:
-        flash('Error synchronizing inventory status!', 'error')
-    return redirect(url_for('index'))
+    job_id = job_queue.enqueue('sync_inventory_status')
+    flash('Inventory status synchronization started.', 'success')
+    return redirect(url_for('job_status', job_id=job_id))
 
 
 @app.route('/toner')
+@conditional_page('toner_inventory')
 def toner_management():
     db = get_db()
     cursor = db.cursor()
@@ -856,7 +1205,16 @@ def toner_management():
     # Get search query from URL parameters
     search_query = request.args.get('search', '').strip()
 
-    if search_query:
+    search_match = get_search_match(search_query)
+
+    if search_match:
+        cursor.execute('''
+            SELECT toner_inventory.* FROM toner_inventory_fts
+            JOIN toner_inventory ON toner_inventory.id = toner_inventory_fts.rowid
+            WHERE toner_inventory_fts MATCH ?
+            ORDER BY toner_inventory_fts.rank, toner_inventory.id DESC
+        ''', (search_match,))
+    elif search_query:
         cursor.execute('''
             SELECT * FROM toner_inventory 
             WHERE name LIKE ? 
@@ -888,6 +1246,7 @@ def add_toner():
                 (name, printer, bk_toner, color, inventory)
             )
             db.commit()
+            cache.bump('toner_inventory')
             flash('Toner added successfully!', 'success')
         except Exception as e:
             flash(f'Error adding toner: {str(e)}', 'error')
@@ -916,6 +1275,7 @@ def edit_toner(id):
                 WHERE id = ?
             ''', (name, printer, bk_toner, color, inventory, id))
             db.commit()
+            cache.bump('toner_inventory')
             flash('Toner updated successfully!', 'success')
             return redirect(url_for('toner_management'))
         except Exception as e:
@@ -934,6 +1294,7 @@ def delete_toner(id):
         cursor = db.cursor()
         cursor.execute('DELETE FROM toner_inventory WHERE id = ?', (id,))
         db.commit()
+        cache.bump('toner_inventory')
         flash('Toner deleted successfully!', 'success')
     except Exception as e:
         flash(f'Error deleting toner: {str(e)}', 'error')
@@ -942,6 +1303,7 @@ def delete_toner(id):
 
 
 @app.route('/cart_templates')
+@conditional_page('cart_templates')
 def cart_templates():
     try:
         db = get_db()
@@ -969,55 +1331,31 @@ def add_cart_template():
 
         if request.method == 'POST':
             name = request.form['name']
-            green_numbers = request.form.getlist('green_numbers[]')
+            green_numbers = list(dict.fromkeys(int(value) for value in request.form.getlist('green_numbers[]')))
 
             if not green_numbers:
                 flash('Please select at least one item for the template', 'error')
                 return redirect(url_for('add_cart_template'))
 
             # Check for duplicate green numbers
-            duplicate_numbers = []
-            for green_number in green_numbers:
-                if is_green_number_in_use(green_number):
-                    cursor.execute('SELECT ct.name FROM cart_templates ct JOIN cart_template_items cti ON ct.id = cti.template_id WHERE cti.green_number = ?', (green_number,))
-                    template = cursor.fetchone()
-                    duplicate_numbers.append(f"Green number {green_number} is already in template '{template['name']}'")
-
-            if duplicate_numbers:
-                flash('Error: \n' + '\n'.join(duplicate_numbers), 'error')
-                cursor.execute('SELECT green_number, name FROM inventory ORDER BY green_number')
-                inventory_items = cursor.fetchall()
+            conflicts = find_template_conflicts(cursor, green_numbers)
+            if conflicts:
+                flash('Error: \n' + '\n'.join(f"Green number {green_number} is already in template '{template_name}'"
+                                               for green_number, template_name in conflicts), 'error')
                 return render_template('add_edit_cart_template.html',
-                                    inventory_items=inventory_items,
                                     template=None,
-                                    selected_items=green_numbers)
+                                    selected_items=get_items_by_green_number(cursor, green_numbers))
 
             cursor.execute('INSERT INTO cart_templates (name) VALUES (?)', (name,))
-            template_id = cursor.lastrowid
-
-            for green_number in green_numbers:
-                cursor.execute('''
-                    INSERT INTO cart_template_items (template_id, green_number) 
-                    VALUES (?, ?)
-                ''', (template_id, green_number))
+            save_template_items(cursor, cursor.lastrowid, green_numbers)
 
             db.commit()
+            cache.bump('cart_templates')
             flash('Template created successfully!', 'success')
             return redirect(url_for('cart_templates'))
 
         # GET request - show form
-        cursor.execute('''
-            SELECT i.green_number, i.name 
-            FROM inventory i 
-            WHERE NOT EXISTS (
-                SELECT 1 FROM cart_template_items cti 
-                WHERE cti.green_number = i.green_number
-            )
-            ORDER BY i.green_number
-        ''')
-        inventory_items = cursor.fetchall()
         return render_template('add_edit_cart_template.html',
-                            inventory_items=inventory_items,
                             template=None,
                             selected_items=[])
 
@@ -1034,41 +1372,26 @@ def edit_cart_template(id):
 
         if request.method == 'POST':
             name = request.form['name']
-            green_numbers = request.form.getlist('green_numbers[]')
+            green_numbers = list(dict.fromkeys(int(value) for value in request.form.getlist('green_numbers[]')))
 
             if not green_numbers:
                 flash('Please select at least one item for the template', 'error')
                 return redirect(url_for('edit_cart_template', id=id))
 
             # Check for duplicate green numbers
-            duplicate_numbers = []
-            for green_number in green_numbers:
-                if is_green_number_in_use(green_number, exclude_template_id=id):
-                    cursor.execute('SELECT ct.name FROM cart_templates ct JOIN cart_template_items cti ON ct.id = cti.template_id WHERE cti.green_number = ?', (green_number,))
-                    template = cursor.fetchone()
-                    duplicate_numbers.append(f"Green number {green_number} is already in template '{template['name']}'")
-
-            if duplicate_numbers:
-                flash('Error: \n' + '\n'.join(duplicate_numbers), 'error')
-                cursor.execute('SELECT green_number, name FROM inventory ORDER BY green_number')
-                inventory_items = cursor.fetchall()
-                cursor.execute('SELECT green_number FROM cart_template_items WHERE template_id = ?', (id,))
-                selected_items = [item['green_number'] for item in cursor.fetchall()]
+            conflicts = find_template_conflicts(cursor, green_numbers, exclude_template_id=id)
+            if conflicts:
+                flash('Error: \n' + '\n'.join(f"Green number {green_number} is already in template '{template_name}'"
+                                               for green_number, template_name in conflicts), 'error')
                 return render_template('add_edit_cart_template.html',
                                     template={'id': id, 'name': name},
-                                    inventory_items=inventory_items,
-                                    selected_items=green_numbers)
+                                    selected_items=get_items_by_green_number(cursor, green_numbers))
 
             cursor.execute('UPDATE cart_templates SET name = ? WHERE id = ?', (name, id))
-            cursor.execute('DELETE FROM cart_template_items WHERE template_id = ?', (id,))
-
-            for green_number in green_numbers:
-                cursor.execute('''
-                    INSERT INTO cart_template_items (template_id, green_number) 
-                    VALUES (?, ?)
-                ''', (id, green_number))
+            save_template_items(cursor, id, green_numbers)
 
             db.commit()
+            cache.bump('cart_templates')
             flash('Template updated successfully!', 'success')
             return redirect(url_for('cart_templates'))
 
@@ -1080,25 +1403,18 @@ def edit_cart_template(id):
             flash('Template not found', 'error')
             return redirect(url_for('cart_templates'))
 
-        cursor.execute('SELECT green_number FROM cart_template_items WHERE template_id = ?', (id,))
-        selected_items = [item['green_number'] for item in cursor.fetchall()]
-
-        # Get available items plus currently selected items
+        # Only the template's own items are rendered, the picker searches for the rest
         cursor.execute('''
-            SELECT i.green_number, i.name 
-            FROM inventory i 
-            WHERE NOT EXISTS (
-                SELECT 1 FROM cart_template_items cti 
-                WHERE cti.green_number = i.green_number 
-                AND cti.template_id != ?
-            )
+            SELECT i.green_number, i.name
+            FROM cart_template_items cti
+            JOIN inventory i ON i.green_number = cti.green_number
+            WHERE cti.template_id = ?
             ORDER BY i.green_number
         ''', (id,))
-        inventory_items = cursor.fetchall()
+        selected_items = cursor.fetchall()
 
         return render_template('add_edit_cart_template.html',
                             template=template,
-                            inventory_items=inventory_items,
                             selected_items=selected_items)
 
     except Exception as e:
@@ -1112,6 +1428,7 @@ def delete_cart_template(id):
         cursor = db.cursor()
         cursor.execute('DELETE FROM cart_templates WHERE id = ?', (id,))
         db.commit()
+        cache.bump('cart_templates')
         flash('Template deleted successfully!', 'success')
     except Exception as e:
         flash(f'Error deleting template: {str(e)}', 'error')
@@ -1128,41 +1445,12 @@ def bulk_return():
 
         loan_ids = request.form.getlist('loan_ids[]')
 
-        # Start transaction
-        cursor.execute('BEGIN TRANSACTION')
-
-        for loan_id in loan_ids:
-            # Get the green number before updating the loan
-            cursor.execute('SELECT green_number FROM loans WHERE id = ?', (loan_id,))
-            loan = cursor.fetchone()
-
-            if loan:
-                # Update loan status to returned
-                cursor.execute('''
-                    UPDATE loans 
-                    SET status = 'returned', return_date = ?
-                    WHERE id = ?
-                ''', (date.today().isoformat(), loan_id))
-
-                # Check if this item has any other active loans
-                cursor.execute('''
-                    SELECT COUNT(*) as active_count 
-                    FROM loans 
-                    WHERE green_number = ? AND status = 'active' AND id != ?
-                ''', (loan['green_number'], loan_id))
-
-                active_count = cursor.fetchone()['active_count']
-
-                # If no other active loans, update inventory status to 'no'
-                if active_count == 0:
-                    cursor.execute('''
-                        UPDATE inventory 
-                        SET status = 'no'
-                        WHERE green_number = ?
-                    ''', (loan['green_number'],))
+        cursor.execute('BEGIN IMMEDIATE')
+        return_loans(cursor, loan_ids)
 
         # Commit transaction
         db.commit()
+        cache.bump('loans')
         flash('Selected loans have been returned successfully!', 'success')
 
     except Exception as e:
@@ -1181,9 +1469,9 @@ def get_borrower_loans(borrower_name):
         cursor.execute('''
             SELECT id, green_number, item_name 
             FROM loans 
-            WHERE borrower_name = ? AND status = 'active'
+            WHERE borrower_id = (SELECT id FROM borrowers WHERE name_key = ?) AND status = 'active'
             ORDER BY loan_date DESC
-        ''', (borrower_name,))
+        ''', (normalize_borrower_name(borrower_name),))
 
         loans = cursor.fetchall()
         return jsonify([dict(loan) for loan in loans])
@@ -1191,6 +1479,76 @@ def get_borrower_loans(borrower_name):
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/borrowers')
+def borrower_autocomplete():
+    """Borrowers whose name starts with the typed text, for the borrower picker"""
+    query = normalize_borrower_name(request.args.get('q', ''))
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    if not query:
+        return jsonify([])
+
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute('''
+        SELECT id, name,
+        (SELECT COUNT(*) FROM loans WHERE loans.borrower_id = borrowers.id AND loans.status = 'active') as active_loans
+        FROM borrowers
+        WHERE name_key >= ? AND name_key < ?
+        ORDER BY name_key
+        LIMIT ?
+    ''', get_prefix_range(query) + [limit])
+    return jsonify([dict(row) for row in cursor.fetchall()])
+
+
+@app.route('/api/items/search')
+def item_search():
+    """
+    Inventory items matching the typed text, for the item pickers
+
+    Green numbers and names are prefix-matched through the search index (LIKE
+    without it), exact green number first. Each item says whether it is
+    available and which cart template holds it, so pickers can disable the
+    ones that can't be chosen.
+    """
+    query = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', 20, type=int), 50))
+
+    db = get_db()
+    cursor = db.cursor()
+    columns = '''
+        inventory.green_number, inventory.name, inventory.status IS NOT 'yes' as available,
+        (SELECT template_id FROM cart_template_items cti
+         WHERE cti.green_number = inventory.green_number LIMIT 1) as template_id
+    '''
+
+    search_match = get_search_match(query)
+    if search_match:
+        cursor.execute(f'''
+            SELECT {columns} FROM inventory_fts
+            JOIN inventory ON inventory.id = inventory_fts.rowid
+            WHERE inventory_fts MATCH ?
+            ORDER BY inventory.green_number IS ? DESC, inventory_fts.rank, inventory.green_number
+            LIMIT ?
+        ''', (f'{{name green_number}} : ({search_match})', int(query) if query.isdigit() else None, limit))
+    elif query:
+        cursor.execute(f'''
+            SELECT {columns} FROM inventory
+            WHERE name LIKE ? OR green_number LIKE ?
+            ORDER BY green_number
+            LIMIT ?
+        ''', (f'%{query}%', f'{query}%', limit))
+    else:
+        cursor.execute(f'SELECT {columns} FROM inventory ORDER BY green_number LIMIT ?', (limit,))
+
+    return jsonify([dict(row, available=bool(row['available'])) for row in cursor.fetchall()])
+
+
+@app.route('/api/cache_stats')
+def cache_stats():
+    """Hit and miss counters of the read cache, and the current table versions"""
+    return jsonify(cache.stats())
+
+
 DATABASE = get_db_path()
 
 if __name__ == '__main__':
@@ -0,0 +1,169 @@
+"""
+Static asset pipeline
+
+Outside debug mode every static file is served under a URL carrying a hash of
+its content (style.3f2a9c1b04de.css), with a year-long immutable
+Cache-Control, from a gzip or brotli copy compressed once at startup. A
+changed file gets a new URL, so browsers never revalidate. In debug mode the
+plain /static URLs are used and templates reload, so edits show straight away.
+
+Third-party files are committed under static/vendor, so pages never need the
+internet. `python assets.py` (run by build.py before packaging) checks them
+against the SHA-256 pinned in VENDOR_ASSETS, fetching any that are missing,
+and fails on a mismatch.
+
+Usage: python assets.py
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+import urllib.request
+
+from flask import Response, abort, current_app, request, url_for
+
+try:
+    import brotli
+except ImportError:
+    # Optional, assets are only gzipped without it
+    brotli = None
+
+# Path under static/ -> (upstream URL, SHA-256 of the committed file)
+VENDOR_ASSETS = {
+    'vendor/jquery-3.6.0.min.js': (
+        'https://code.jquery.com/jquery-3.6.0.min.js',
+        'ff1523fb7389539c84c65aba19260648793bb4f5e29329d2ee8804bc37a3fe6e'),
+    'vendor/select2-4.1.0-rc.0.min.js': (
+        'https://cdn.jsdelivr.net/npm/select2@4.1.0-rc.0/dist/js/select2.min.js',
+        'ad6c771f1b4cb0ce73fbefe833ac92db097a01a026c30e78f67ba5224424bda1'),
+    'vendor/select2-4.1.0-rc.0.min.css': (
+        'https://cdn.jsdelivr.net/npm/select2@4.1.0-rc.0/dist/css/select2.min.css',
+        'cda4a81c187015d95ed2c71f1841540b08203cdec5fa2a7d5d1825a3c2166f8c'),
+    'vendor/signature_pad-4.1.7.umd.min.js': (
+        'https://cdnjs.cloudflare.com/ajax/libs/signature_pad/4.1.7/signature_pad.umd.min.js',
+        'ffc6bfdd82e7ed4941c7da170f1a6ae4be3b7cb1036f6f60edb09617a868e7a4'),
+}
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+# Precompressed copies smaller than this aren't worth a Content-Encoding
+MIN_COMPRESS_SIZE = 512
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class Asset:
+    """One static file with its fingerprinted name and encoded bodies"""
+
+    def __init__(self, filename, data):
+        digest = hashlib.sha256(data).hexdigest()
+        stem, extension = os.path.splitext(filename)
+        self.filename = filename
+        self.hashed_name = f'{stem}.{digest[:12]}{extension}'
+        self.etag = digest[:32]
+        self.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self.bodies = {'identity': data}
+
+        if len(data) >= MIN_COMPRESS_SIZE and self.mimetype.startswith(COMPRESSIBLE_TYPES):
+            compressed = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                compressed['br'] = brotli.compress(data, quality=11)
+            self.bodies.update({encoding: body for encoding, body in compressed.items() if len(body) < len(data)})
+
+
+class Assets:
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._by_filename = None
+        self._by_hashed_name = None
+        self.static_folder = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        app.add_url_rule('/assets/<path:hashed_name>', 'asset', self.serve)
+        app.add_template_global(self.url, 'asset_url')
+
+    def load(self):
+        """Fingerprint and compress every static file, once"""
+        if self._by_filename is None:
+            with self._lock:
+                if self._by_filename is None:
+                    by_filename = {}
+                    for root, _, files in os.walk(self.static_folder):
+                        for name in files:
+                            path = os.path.join(root, name)
+                            filename = os.path.relpath(path, self.static_folder).replace(os.sep, '/')
+                            with open(path, 'rb') as handle:
+                                by_filename[filename] = Asset(filename, handle.read())
+                    self._by_hashed_name = {asset.hashed_name: asset for asset in by_filename.values()}
+                    self._by_filename = by_filename
+        return self._by_filename
+
+    def url(self, filename):
+        """URL of a static file, fingerprinted unless debugging"""
+        if current_app.debug:
+            return url_for('static', filename=filename)
+
+        asset = self.load().get(filename)
+        if asset is None:
+            raise FileNotFoundError(f'Static file {filename} does not exist')
+        return url_for('asset', hashed_name=asset.hashed_name)
+
+    def serve(self, hashed_name):
+        self.load()
+        asset = self._by_hashed_name.get(hashed_name)
+        if asset is None:
+            abort(404)
+
+        encoding = 'identity'
+        for candidate in ('br', 'gzip'):
+            if candidate in asset.bodies and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+
+        response = Response(asset.bodies[encoding], mimetype=asset.mimetype)
+        if encoding != 'identity':
+            response.content_encoding = encoding
+        response.vary.add('Accept-Encoding')
+        response.set_etag(asset.etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+        return response.make_conditional(request)
+
+
+def vendor_assets(static_folder):
+    """
+    Check the vendored files against their pinned hashes, fetching any that are missing
+
+    Raises:
+        ValueError: a committed or downloaded file doesn't match its pin
+    """
+    for filename, (url, expected) in VENDOR_ASSETS.items():
+        path = os.path.join(static_folder, filename)
+        if os.path.exists(path):
+            with open(path, 'rb') as handle:
+                data = handle.read()
+        else:
+            print(f'Fetching {url}')
+            with urllib.request.urlopen(url, timeout=30) as source:
+                data = source.read()
+
+        actual = hashlib.sha256(data).hexdigest()
+        if actual != expected:
+            raise ValueError(f'{filename} has SHA-256 {actual}, expected {expected}')
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as target:
+                target.write(data)
+
+
+assets = Assets()
+
+
+if __name__ == '__main__':
+    vendor_assets(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
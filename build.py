@@ -1,5 +1,10 @@
 import PyInstaller.__main__
 
+from assets import vendor_assets
+
+# The packaged app runs offline, so third-party scripts must be bundled
+vendor_assets('static')
+
 PyInstaller.__main__.run([
     'run.py',
     '--name=Inventory_Management',
@@ -0,0 +1,80 @@
+"""
+In-process read cache invalidated by table versions
+
+Every cached value names the tables it was read from. Write paths call
+bump() with the tables they changed once their transaction is committed,
+which makes every value read from those tables stale at once. Entries also
+expire after a TTL, as a safety net for changes made outside the app, and
+the least recently used ones are evicted when the cache is full.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TableCache:
+    def __init__(self, max_entries=256, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._versions = {}
+        # key -> (table versions, expires_at, value), least recently used first
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def version(self, table):
+        return self._versions.get(table, 0)
+
+    def bump(self, *tables):
+        """Mark tables as changed; call after the write is committed, never before"""
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def get(self, key, tables, load, ttl=None):
+        """
+        Return the cached value of key, calling load() when it is missing or stale
+
+        The table versions are taken before load() runs, so a write committed
+        while loading leaves the entry stale rather than caching old data as new.
+        """
+        with self._lock:
+            now = time.monotonic()
+            versions = tuple(self._versions.get(table, 0) for table in tables)
+            entry = self._entries.get(key)
+            if entry and entry[0] == versions and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        value = load()
+
+        with self._lock:
+            self._entries[key] = (versions, now + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'versions': dict(self._versions),
+            }
+
+
+cache = TableCache()
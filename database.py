@@ -1,6 +1,11 @@
 import sqlite3
 import os
 import sys
+import json
+import base64
+import binascii
+import hashlib
+import queue
 from flask import g
 
 
@@ -25,12 +30,366 @@ def get_db_path():
     return db_path
 
 
-def create_tables(connection):
-    """Create all necessary tables"""
+# Registered migrations: version -> (upgrade, backfill)
+MIGRATIONS = {}
+
+# Rows touched per commit by batched backfills
+BACKFILL_BATCH_SIZE = 500
+
+# Loan period of the default loan policy, and of loans made before policies existed
+LOAN_PERIOD_DAYS = 7
+
+
+def migration(version, backfill=None):
+    """
+    Register a numbered schema migration
+
+    The upgrade function runs inside one transaction together with the
+    user_version bump. An optional backfill(connection) runs afterwards in
+    small committed batches so large tables are never locked for long; the
+    version is only bumped once it finishes, so an interrupted backfill
+    resumes on the next start. Both steps must be safe to re-run.
+    """
+    def register(upgrade):
+        if version in MIGRATIONS:
+            raise ValueError(f'Duplicate migration version {version}')
+        MIGRATIONS[version] = (upgrade, backfill)
+        return upgrade
+    return register
+
+
+def execute_script(cursor, script):
+    """Run a multi-statement script inside the current transaction (executescript would commit)"""
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            cursor.execute(statement)
+            statement = ''
+
+
+def add_column(cursor, table, column, definition):
+    """Add a column unless it already exists"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def backfill_in_batches(connection, statement, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Repeat a batched UPDATE/INSERT until it stops changing rows, committing each batch
+
+    The statement takes the batch size as its only parameter, e.g.
+    UPDATE t SET c = ... WHERE id IN (SELECT id FROM t WHERE c IS NULL LIMIT ?)
+    """
+    total = 0
+    while True:
+        cursor = connection.execute(statement, (batch_size,))
+        connection.commit()
+        if cursor.rowcount <= 0:
+            return total
+        total += cursor.rowcount
+
+
+def find_duplicate_green_numbers(cursor):
+    """Green numbers used by more than one inventory row, as (green_number, 'id, id, ...') rows"""
+    cursor.execute('''
+        SELECT green_number, GROUP_CONCAT(id, ', ') AS ids
+        FROM inventory
+        GROUP BY green_number
+        HAVING COUNT(*) > 1
+        ORDER BY green_number
+    ''')
+    return cursor.fetchall()
+
+
+def has_unique_green_numbers(cursor):
+    """Whether the unique index that imports upsert on exists"""
+    cursor.execute('''
+        SELECT 1 FROM pragma_index_list('inventory')
+        WHERE name = 'idx_inventory_green_number' AND "unique" = 1
+    ''')
+    return cursor.fetchone() is not None
+
+
+def create_unique_green_number_index(cursor):
+    """
+    Make inventory.green_number unique unless duplicates are left, inside the current transaction
+
+    Returns:
+        bool: whether the unique index exists afterwards
+    """
+    if has_unique_green_numbers(cursor):
+        return True
+    if find_duplicate_green_numbers(cursor):
+        return False
+    execute_script(cursor, '''
+        DROP INDEX IF EXISTS idx_inventory_green_number;
+        CREATE UNIQUE INDEX idx_inventory_green_number ON inventory(green_number);
+    ''')
+    return True
+
+
+def ensure_unique_green_numbers(connection):
+    """Create the unique green number index once the duplicates are resolved, returning whether it exists"""
+    if has_unique_green_numbers(connection.cursor()):
+        return True
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        created = create_unique_green_number_index(connection.cursor())
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    if created:
+        print("Green numbers are unique now, imports are enabled")
+    return created
+
+
+def get_schema_version(connection):
+    return connection.execute('PRAGMA user_version').fetchone()[0]
+
+
+def get_latest_schema_version():
+    return max(MIGRATIONS)
+
+
+def apply_migrations(connection):
+    """Bring the database up to the latest schema version, returning the version"""
+    current = get_schema_version(connection)
+    latest = get_latest_schema_version()
+    if current >= latest:
+        return current
+
+    for version in sorted(MIGRATIONS):
+        if version <= current:
+            continue
+        upgrade, backfill = MIGRATIONS[version]
+
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have migrated while we waited for the write lock
+            if get_schema_version(connection) >= version:
+                connection.rollback()
+                continue
+            upgrade(connection.cursor())
+            if backfill is None:
+                connection.execute(f'PRAGMA user_version = {version}')
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+        if backfill is not None:
+            backfill(connection)
+            connection.execute(f'PRAGMA user_version = {version}')
+            connection.commit()
+
+        print(f"Applied migration {version}: {upgrade.__doc__}")
+
+    return latest
+
+
+# Full-text indexes: index name -> (source table, indexed columns)
+SEARCH_INDEXES = {
+    'inventory_fts': ('inventory', ('name', 'category', 'green_number')),
+    'toner_inventory_fts': ('toner_inventory', ('name', 'printer', 'color')),
+}
+
+_fts5_available = None
+
+
+def search_index_available():
+    """Return True when the FTS5 search indexes are in use"""
+    return bool(_fts5_available)
+
+
+def detect_search_indexes(connection):
+    """Remember whether the FTS5 search indexes exist in this database"""
+    global _fts5_available
+    placeholders = ', '.join('?' * len(SEARCH_INDEXES))
+    cursor = connection.execute(
+        f"SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name IN ({placeholders})",
+        tuple(SEARCH_INDEXES))
+    _fts5_available = cursor.fetchone()[0] == len(SEARCH_INDEXES)
+
+
+def create_search_indexes(cursor):
+    """Create FTS5 indexes kept in sync by triggers, backfilling any that are new"""
+    try:
+        cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS temp.fts5_probe USING fts5(x)')
+        cursor.execute('DROP TABLE temp.fts5_probe')
+    except sqlite3.OperationalError:
+        # SQLite built without FTS5, searches fall back to LIKE
+        print("FTS5 is not available, using LIKE search")
+        return
+
+    for index_name, (table, columns) in SEARCH_INDEXES.items():
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (index_name,))
+        if cursor.fetchone():
+            continue
+
+        column_list = ', '.join(columns)
+        new_values = ', '.join(f'new.{column}' for column in columns)
+        old_values = ', '.join(f'old.{column}' for column in columns)
+        execute_script(cursor, f'''
+            CREATE VIRTUAL TABLE {index_name} USING fts5(
+                {column_list}, content='{table}', content_rowid='id'
+            );
+
+            CREATE TRIGGER IF NOT EXISTS {index_name}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {index_name} (rowid, {column_list}) VALUES (new.id, {new_values});
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS {index_name}_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {index_name} ({index_name}, rowid, {column_list})
+                VALUES ('delete', old.id, {old_values});
+            END;
+
+            -- Only reindex when a searchable column changes, not on status flips
+            CREATE TRIGGER IF NOT EXISTS {index_name}_update AFTER UPDATE OF {column_list} ON {table} BEGIN
+                INSERT INTO {index_name} ({index_name}, rowid, {column_list})
+                VALUES ('delete', old.id, {old_values});
+                INSERT INTO {index_name} (rowid, {column_list}) VALUES (new.id, {new_values});
+            END;
+
+            -- Backfill rows that existed before the index
+            INSERT INTO {index_name} ({index_name}) VALUES ('rebuild');
+        ''')
+        print(f"Created search index {index_name}")
+
+
+# The signature pad produces PNG; anything else (SVG above all, which can carry
+# script) must never be stored and served back from our origin
+SIGNATURE_MIME_TYPES = ('image/png', 'image/jpeg')
+
+
+def decode_signature(data_url):
+    """Decode a signature pad data URL into (mime_type, image_bytes)"""
+    header, separator, payload = data_url.partition(',')
+    if not separator or not header.startswith('data:') or not header.endswith(';base64'):
+        raise ValueError('Signature must be a base64 encoded image')
+    mime_type = header[len('data:'):-len(';base64')].lower()
+    if mime_type not in SIGNATURE_MIME_TYPES:
+        raise ValueError('Signature must be a PNG or JPEG image')
+    try:
+        data = base64.b64decode(payload, validate=True)
+    except binascii.Error:
+        raise ValueError('Signature data is not valid base64')
+    return mime_type, data
+
+
+def store_signature(cursor, data_url):
+    """Store a signature once, keyed by the SHA-256 of its bytes, and return the hash"""
+    mime_type, data = decode_signature(data_url)
+    signature_hash = hashlib.sha256(data).hexdigest()
+    cursor.execute(
+        'INSERT OR IGNORE INTO signatures (hash, mime_type, data) VALUES (?, ?, ?)',
+        (signature_hash, mime_type, data)
+    )
+    return signature_hash
+
+
+def migrate_inline_signatures(connection, batch_size=200):
+    """
+    Move base64 signatures stored inline on loans into the signatures table
+
+    Pages through loans by id, so a value that can't be decoded is simply left
+    where it is (it may be the only copy) and logged, without stalling the loop.
+    """
     cursor = connection.cursor()
+    moved = 0
+    skipped = []
+    last_id = 0
+    while True:
+        cursor.execute(
+            'SELECT id, signature FROM loans WHERE id > ? AND signature IS NOT NULL ORDER BY id LIMIT ?',
+            (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        for loan_id, signature in rows:
+            try:
+                signature_hash = store_signature(cursor, signature)
+            except ValueError:
+                skipped.append(loan_id)
+                continue
+            cursor.execute(
+                'UPDATE loans SET signature_hash = ?, signature = NULL WHERE id = ?',
+                (signature_hash, loan_id)
+            )
+            moved += 1
+        connection.commit()
+        last_id = rows[-1][0]
+
+    if moved:
+        print(f"Moved {moved} inline signatures into the signature store")
+    if skipped:
+        shown = ', '.join(map(str, skipped[:20])) + (', ...' if len(skipped) > 20 else '')
+        print(f"Left {len(skipped)} unreadable inline signatures in place, loan ids: {shown}")
+
+
+# inventory.status of the current inventory row: 'yes' while any loan of it is active
+DERIVED_INVENTORY_STATUS = '''
+    CASE WHEN EXISTS (
+        SELECT 1 FROM loans
+        WHERE loans.green_number = inventory.green_number AND loans.status = 'active'
+    ) THEN 'yes' ELSE 'no' END
+'''
+
 
-    # Create tables with consolidated schema
-    cursor.executescript('''
+def repair_inventory_status(cursor):
+    """
+    Fix inventory rows whose status disagrees with their loans
+
+    Triggers keep the status current, so this normally only reads; rows are
+    rewritten only when they have drifted. Returns the number repaired.
+    """
+    cursor.execute(f'''
+        UPDATE inventory
+        SET status = {DERIVED_INVENTORY_STATUS}
+        WHERE status IS NOT {DERIVED_INVENTORY_STATUS}
+    ''')
+    return cursor.rowcount
+
+
+def normalize_borrower_name(name):
+    """Key that identifies a borrower regardless of case and spacing"""
+    return ' '.join(name.split()).casefold()
+
+
+def get_borrower_id(cursor, name):
+    """Return the id of a borrower, creating the borrower on first use"""
+    name = ' '.join(name.split())
+    name_key = normalize_borrower_name(name)
+    cursor.execute('INSERT OR IGNORE INTO borrowers (name, name_key) VALUES (?, ?)', (name, name_key))
+    cursor.execute('SELECT id FROM borrowers WHERE name_key = ?', (name_key,))
+    return cursor.fetchone()[0]
+
+
+def link_loan_borrowers(connection):
+    """Create a borrower for every distinct loan borrower name and link the loans to it"""
+    cursor = connection.cursor()
+    cursor.execute('SELECT DISTINCT borrower_name FROM loans WHERE borrower_id IS NULL')
+    for (name,) in cursor.fetchall():
+        get_borrower_id(cursor, name)
+    connection.commit()
+
+    # One pass over the loans instead of a scan per name
+    connection.create_function('normalize_borrower_name', 1, normalize_borrower_name, deterministic=True)
+    backfill_in_batches(connection, '''
+        UPDATE loans SET borrower_id = (
+            SELECT id FROM borrowers WHERE name_key = normalize_borrower_name(loans.borrower_name)
+        )
+        WHERE id IN (SELECT id FROM loans WHERE borrower_id IS NULL LIMIT ?)
+    ''')
+
+
+@migration(1)
+def initial_schema(cursor):
+    """Create the original inventory, loans, toner and cart template tables"""
+    execute_script(cursor, '''
         -- Create inventory table
         CREATE TABLE IF NOT EXISTS inventory (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -79,7 +438,7 @@ def create_tables(connection):
         CREATE INDEX IF NOT EXISTS idx_loans_green_number ON loans(green_number);
         CREATE INDEX IF NOT EXISTS idx_loans_status ON loans(status);
         CREATE INDEX IF NOT EXISTS idx_toner_printer ON toner_inventory(printer);
-        
+
         -- Create cart_templates table
         CREATE TABLE IF NOT EXISTS cart_templates (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -101,64 +460,477 @@ def create_tables(connection):
     ''')
 
 
+@migration(2, backfill=migrate_inline_signatures)
+def signature_store(cursor):
+    """Add the content-addressed signature store"""
+    execute_script(cursor, '''
+        CREATE TABLE IF NOT EXISTS signatures (
+            hash TEXT PRIMARY KEY,
+            mime_type TEXT NOT NULL DEFAULT 'image/png',
+            data BLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    ''')
+    add_column(cursor, 'loans', 'signature_hash', 'TEXT REFERENCES signatures (hash)')
+
+
+@migration(3)
+def search_indexes(cursor):
+    """Add FTS5 search indexes for inventory and toner"""
+    create_search_indexes(cursor)
+
+
+@migration(4)
+def inventory_created_at_index(cursor):
+    """Index inventory.created_at for date-sorted pages"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_created_at ON inventory(created_at)')
 
-    connection.commit()
+
+@migration(5)
+def unique_green_numbers(cursor):
+    """Make inventory.green_number unique so imports can upsert on it"""
+    # Older versions allowed duplicates. Those are real items someone has to
+    # reconcile, so the index waits for them (see create_unique_green_number_index)
+    if not create_unique_green_number_index(cursor):
+        print("Green numbers are not unique yet, imports stay disabled until the duplicates are resolved")
+
+
+@migration(6)
+def jobs_table(cursor):
+    """Track long-running jobs such as resumable imports"""
+    execute_script(cursor, '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending'
+                CHECK(status IN ('pending', 'running', 'completed', 'failed')),
+            filename TEXT,
+            file_path TEXT,
+            rows_processed INTEGER NOT NULL DEFAULT 0,
+            rows_imported INTEGER NOT NULL DEFAULT 0,
+            error_count INTEGER NOT NULL DEFAULT 0,
+            errors TEXT NOT NULL DEFAULT '[]',
+            message TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_jobs_created_at ON jobs(created_at);
+    ''')
+
+
+@migration(7)
+def job_results(cursor):
+    """Store the result of background jobs"""
+    add_column(cursor, 'jobs', 'result', 'TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)')
+
+
+@migration(8)
+def inventory_status_triggers(cursor):
+    """Derive inventory status from loans with triggers"""
+    execute_script(cursor, f'''
+        CREATE TRIGGER IF NOT EXISTS loans_inventory_status_insert
+        AFTER INSERT ON loans WHEN new.status = 'active' BEGIN
+            UPDATE inventory SET status = 'yes'
+            WHERE green_number = new.green_number AND status IS NOT 'yes';
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS loans_inventory_status_update
+        AFTER UPDATE OF status, green_number ON loans BEGIN
+            UPDATE inventory SET status = {DERIVED_INVENTORY_STATUS}
+            WHERE green_number IN (old.green_number, new.green_number);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS loans_inventory_status_delete
+        AFTER DELETE ON loans WHEN old.status = 'active' BEGIN
+            UPDATE inventory SET status = {DERIVED_INVENTORY_STATUS}
+            WHERE green_number = old.green_number;
+        END;
+
+        -- Edits and imports can't set a status that contradicts the loans
+        CREATE TRIGGER IF NOT EXISTS inventory_status_insert
+        AFTER INSERT ON inventory BEGIN
+            UPDATE inventory SET status = {DERIVED_INVENTORY_STATUS}
+            WHERE id = new.id AND status IS NOT {DERIVED_INVENTORY_STATUS};
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS inventory_status_update
+        AFTER UPDATE OF status, green_number ON inventory BEGIN
+            UPDATE inventory SET status = {DERIVED_INVENTORY_STATUS}
+            WHERE id = new.id AND status IS NOT {DERIVED_INVENTORY_STATUS};
+        END;
+    ''')
+    repair_inventory_status(cursor)
+
+
+def backfill_due_dates(connection):
+    backfill_in_batches(connection, f'''
+        UPDATE loans SET due_date = date(loan_date, '+{LOAN_PERIOD_DAYS} days')
+        WHERE id IN (SELECT id FROM loans WHERE due_date IS NULL LIMIT ?)
+    ''')
+
+
+@migration(9, backfill=backfill_due_dates)
+def loan_due_dates(cursor):
+    """Store loan due dates so overdue loans are an index range"""
+    add_column(cursor, 'loans', 'due_date', 'TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_loans_status_due_date ON loans(status, due_date)')
+
+
+@migration(10)
+def loan_policies(cursor):
+    """Per-category loan periods and extension rules"""
+    execute_script(cursor, f'''
+        CREATE TABLE IF NOT EXISTS loan_policies (
+            category TEXT PRIMARY KEY,
+            loan_days INTEGER NOT NULL CHECK(loan_days > 0),
+            extension_days INTEGER NOT NULL CHECK(extension_days > 0),
+            max_extensions INTEGER CHECK(max_extensions >= 0),
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        -- '*' applies to every category without a policy of its own
+        INSERT OR IGNORE INTO loan_policies (category, loan_days, extension_days)
+        VALUES ('*', {LOAN_PERIOD_DAYS}, {LOAN_PERIOD_DAYS});
+    ''')
+    add_column(cursor, 'loans', 'extensions', 'INTEGER NOT NULL DEFAULT 0')
+
+
+@migration(11, backfill=link_loan_borrowers)
+def borrowers(cursor):
+    """Borrowers table keyed by normalized name"""
+    execute_script(cursor, '''
+        CREATE TABLE IF NOT EXISTS borrowers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            name_key TEXT NOT NULL UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    ''')
+    add_column(cursor, 'loans', 'borrower_id', 'INTEGER REFERENCES borrowers (id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_loans_borrower_id ON loans(borrower_id)')
+
+
+@migration(12)
+def query_shape_indexes(cursor):
+    """Composite and partial indexes for the loan, equipment and template queries"""
+    execute_script(cursor, '''
+        -- Active-loan checks per item (checkout, overdue flags, status triggers)
+        DROP INDEX IF EXISTS idx_loans_green_number;
+        CREATE INDEX IF NOT EXISTS idx_loans_green_number_status ON loans(green_number, status);
+
+        -- Loan history paged by green number
+        CREATE INDEX IF NOT EXISTS idx_loans_status_green_number ON loans(status, green_number);
+
+        -- Active loans by date and by borrower (loans page, borrower lookups)
+        CREATE INDEX IF NOT EXISTS idx_loans_status_loan_date ON loans(status, loan_date);
+        CREATE INDEX IF NOT EXISTS idx_loans_active_borrower ON loans(borrower_id, loan_date)
+            WHERE status = 'active';
+        DROP INDEX IF EXISTS idx_loans_borrower_id;
+
+        CREATE INDEX IF NOT EXISTS idx_loans_equipment_loan_id ON loans_equipment(loan_id);
+        CREATE INDEX IF NOT EXISTS idx_cart_template_items_green_number ON cart_template_items(green_number);
+        CREATE INDEX IF NOT EXISTS idx_inventory_category ON inventory(category);
+    ''')
+
+
+def backfill_template_versions(connection):
+    backfill_in_batches(connection, '''
+        UPDATE cart_templates SET updated_at = created_at
+        WHERE id IN (SELECT id FROM cart_templates WHERE updated_at IS NULL LIMIT ?)
+    ''')
+
+
+# Bumps the version of the templates holding any of the given green numbers
+BUMP_TEMPLATES_BY_ITEM = '''
+            UPDATE cart_templates SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE id IN (SELECT template_id FROM cart_template_items WHERE green_number IN ({}));
+'''
+
+
+@migration(13, backfill=backfill_template_versions)
+def cart_template_versions(cursor):
+    """Version counter on cart templates, bumped whenever a template's item list could read differently"""
+    add_column(cursor, 'cart_templates', 'version', 'INTEGER NOT NULL DEFAULT 1')
+    add_column(cursor, 'cart_templates', 'updated_at', 'TIMESTAMP')
+    execute_script(cursor, f'''
+        CREATE TRIGGER IF NOT EXISTS cart_templates_version_rename
+        AFTER UPDATE OF name ON cart_templates WHEN old.name IS NOT new.name BEGIN
+            UPDATE cart_templates SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE id = new.id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS cart_template_items_version_insert
+        AFTER INSERT ON cart_template_items BEGIN
+            UPDATE cart_templates SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE id = new.template_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS cart_template_items_version_delete
+        AFTER DELETE ON cart_template_items BEGIN
+            UPDATE cart_templates SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE id = old.template_id;
+        END;
+
+        -- Item names and availability are part of the template items response.
+        -- Availability follows inventory.status, which the loan triggers keep current.
+        CREATE TRIGGER IF NOT EXISTS inventory_template_version_insert
+        AFTER INSERT ON inventory BEGIN
+            {BUMP_TEMPLATES_BY_ITEM.format('new.green_number')}
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS inventory_template_version_update
+        AFTER UPDATE OF name, green_number, status ON inventory
+        WHEN old.name IS NOT new.name OR old.green_number IS NOT new.green_number OR old.status IS NOT new.status BEGIN
+            {BUMP_TEMPLATES_BY_ITEM.format('old.green_number, new.green_number')}
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS inventory_template_version_delete
+        AFTER DELETE ON inventory BEGIN
+            {BUMP_TEMPLATES_BY_ITEM.format('old.green_number')}
+        END;
+    ''')
+
+
+
+@migration(14)
+def loan_signature_index(cursor):
+    """Index loans by signature so archiving can tell which signatures are still in use"""
+    execute_script(cursor, '''
+        CREATE INDEX IF NOT EXISTS idx_loans_signature_hash ON loans(signature_hash)
+        WHERE signature_hash IS NOT NULL;
+    ''')
 
 
-# Create database file if it doesn't exist
 DATABASE = get_db_path()
-if not os.path.exists(DATABASE):
-    conn = sqlite3.connect(DATABASE)
-    create_tables(conn)  # Create tables immediately when database is created
-    conn.close()
-    print(f"Created new database file with tables: {DATABASE}")
+
+# Returned loans past the archive age live here, attached to every connection as 'archive'
+ARCHIVE_DATABASE = os.path.splitext(DATABASE)[0] + '_archive.db'
+
+# Columns shared by main.loans and archive.loans; a migration adding a loans
+# column must add it to ARCHIVE_SCHEMA and here as well
+LOAN_COLUMNS = ('id', 'borrower_name', 'borrower_id', 'item_name', 'green_number', 'loan_date', 'due_date',
+                'return_date', 'extensions', 'signature', 'signature_hash', 'status')
+
+ARCHIVE_SCHEMA = f'''
+    CREATE TABLE IF NOT EXISTS archive.loans (
+        id INTEGER PRIMARY KEY,
+        borrower_name TEXT NOT NULL,
+        borrower_id INTEGER,
+        item_name TEXT NOT NULL,
+        green_number INTEGER NOT NULL,
+        loan_date TEXT NOT NULL,
+        due_date TEXT,
+        return_date TEXT,
+        extensions INTEGER NOT NULL DEFAULT 0,
+        signature TEXT,
+        signature_hash TEXT,
+        status TEXT
+    );
+    CREATE INDEX IF NOT EXISTS archive.idx_loans_status ON loans(status);
+    CREATE INDEX IF NOT EXISTS archive.idx_loans_status_green_number ON loans(status, green_number);
+
+    CREATE TABLE IF NOT EXISTS archive.loans_equipment (
+        id INTEGER PRIMARY KEY,
+        loan_id INTEGER NOT NULL,
+        equipment_type TEXT NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 1
+    );
+    CREATE INDEX IF NOT EXISTS archive.idx_loans_equipment_loan_id ON loans_equipment(loan_id);
+
+    CREATE TABLE IF NOT EXISTS archive.signatures (
+        hash TEXT PRIMARY KEY,
+        mime_type TEXT NOT NULL DEFAULT 'image/png',
+        data BLOB NOT NULL,
+        created_at TIMESTAMP
+    );
+
+    -- Hot and archived rows together, for history pages and loan details
+    CREATE TEMP VIEW IF NOT EXISTS all_loans AS
+        SELECT {', '.join(LOAN_COLUMNS)} FROM main.loans
+        UNION ALL
+        SELECT {', '.join(LOAN_COLUMNS)} FROM archive.loans;
+
+    CREATE TEMP VIEW IF NOT EXISTS all_loans_equipment AS
+        SELECT id, loan_id, equipment_type, quantity FROM main.loans_equipment
+        UNION ALL
+        SELECT id, loan_id, equipment_type, quantity FROM archive.loans_equipment;
+
+    CREATE TEMP VIEW IF NOT EXISTS all_signatures AS
+        SELECT hash, mime_type, data FROM main.signatures
+        UNION ALL
+        SELECT hash, mime_type, data FROM archive.signatures;
+'''
+
+
+def attach_archive(connection, path=ARCHIVE_DATABASE):
+    """Attach the archive database to a connection and create its tables and the combined views"""
+    connection.execute('ATTACH DATABASE ? AS archive', (path,))
+    connection.execute('PRAGMA archive.journal_mode = WAL')
+    execute_script(connection.cursor(), ARCHIVE_SCHEMA)
+
+
+def archive_returned_loans(connection, older_than_days, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Move loans returned more than older_than_days ago, with their equipment, into the archive
+
+    Signatures go along once no loan left in the main database uses them. Each
+    batch is copied and deleted in one transaction. With WAL the two files
+    don't commit as a unit, so the copy replaces rows by id: a batch cut off
+    between the two commits is simply moved again on the next run. The pages
+    freed in the main database are handed back to the filesystem at the end.
+
+    Returns:
+        int: number of loans moved
+    """
+    columns = ', '.join(LOAN_COLUMNS)
+    moved = 0
+    while True:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = connection.execute('''
+                SELECT id FROM main.loans
+                WHERE status = 'returned' AND return_date < date('now', ?)
+                ORDER BY id
+                LIMIT ?
+            ''', (f'-{older_than_days} days', batch_size))
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                connection.rollback()
+                if moved:
+                    reclaim_free_pages(connection)
+                return moved
+
+            batch = json.dumps(ids)
+            for statement in (
+                f'INSERT OR REPLACE INTO archive.loans ({columns}) '
+                f'SELECT {columns} FROM main.loans WHERE id IN (SELECT value FROM json_each(?))',
+                'INSERT OR REPLACE INTO archive.loans_equipment (id, loan_id, equipment_type, quantity) '
+                'SELECT id, loan_id, equipment_type, quantity FROM main.loans_equipment '
+                'WHERE loan_id IN (SELECT value FROM json_each(?))',
+                'INSERT OR IGNORE INTO archive.signatures (hash, mime_type, data, created_at) '
+                'SELECT hash, mime_type, data, created_at FROM main.signatures '
+                'WHERE hash IN (SELECT signature_hash FROM main.loans WHERE id IN (SELECT value FROM json_each(?)))',
+                'DELETE FROM main.loans_equipment WHERE loan_id IN (SELECT value FROM json_each(?))',
+                'DELETE FROM main.loans WHERE id IN (SELECT value FROM json_each(?))',
+                # Only now that the batch is gone can we see which signatures nothing in main still uses
+                'DELETE FROM main.signatures '
+                'WHERE hash IN (SELECT signature_hash FROM archive.loans WHERE id IN (SELECT value FROM json_each(?))) '
+                'AND NOT EXISTS (SELECT 1 FROM main.loans WHERE signature_hash = main.signatures.hash)',
+            ):
+                connection.execute(statement, (batch,))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        moved += len(ids)
+
+
+def enable_incremental_vacuum(connection):
+    """
+    Switch the main database to incremental auto-vacuum, so reclaim_free_pages() can shrink it
+
+    Converting an existing database takes one full VACUUM, which locks it for
+    as long as the rewrite takes, so this only runs at startup before requests
+    and jobs are served.
+    """
+    if connection.execute('PRAGMA main.auto_vacuum').fetchone()[0] != 2:
+        print("Enabling incremental vacuum, rebuilding the database once")
+        connection.execute('PRAGMA main.auto_vacuum = INCREMENTAL')
+        connection.execute('VACUUM main')
+
+
+def reclaim_free_pages(connection):
+    """Return the main database's free pages to the filesystem, if incremental auto-vacuum is on"""
+    if connection.execute('PRAGMA main.auto_vacuum').fetchone()[0] == 2:
+        # Frees one page per step, and execute() would only step it once
+        connection.executescript('PRAGMA main.incremental_vacuum;')
+
+
+# Applied to every pooled connection when it is opened
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',  # readers no longer block on the writer
+    'PRAGMA synchronous = NORMAL',  # safe with WAL, avoids an fsync per commit
+    'PRAGMA cache_size = -16000',  # 16MB page cache per connection
+    'PRAGMA mmap_size = 268435456',  # map up to 256MB of the file
+    'PRAGMA busy_timeout = 5000',  # wait for a writer instead of failing with 'database is locked'
+)
+
+
+class ConnectionPool:
+    """
+    Reusable, pre-configured SQLite connections
+
+    The threaded dev server starts a new thread for every request, so connections
+    are handed to whichever thread serves the request rather than kept per thread.
+    At most max_idle connections are kept open between requests.
+    """
+
+    def __init__(self, database, archive=ARCHIVE_DATABASE, max_idle=8):
+        self.database = database
+        self.archive = archive
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.database, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            connection.execute(pragma)
+        attach_archive(connection, self.archive)
+        return connection
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, connection):
+        # Never hand a half-finished transaction to the next request
+        if connection.in_transaction:
+            connection.rollback()
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+
+pool = ConnectionPool(DATABASE)
 
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row
-
-        # Verify tables exist, create if they don't
-        create_tables(g.db)
+        g.db = pool.acquire()
     return g.db
 
 
 def close_db(e=None):
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        pool.release(db)
 
 
 def init_db():
-    """Initialize database and create tables if they don't exist"""
+    """
+    Initialize the database, applying any pending schema migrations
+
+    Raises:
+        Exception: a migration failed; the database is left at the last version that applied
+    """
     try:
         db = get_db()
-        create_tables(db)  # Ensure tables exist
-        print("Database initialized successfully")
+        version = apply_migrations(db)
+        ensure_unique_green_numbers(db)
+        enable_incremental_vacuum(db)
+        detect_search_indexes(db)
+        # Refresh planner statistics where they are missing or stale, so the
+        # composite and partial indexes get picked
+        db.execute('PRAGMA optimize')
+        print(f"Database initialized successfully (schema version {version})")
         return True
     except Exception as e:
         print(f"Error initializing database: {e}")
         if 'db' in g:
             g.db.rollback()
-        return False
-
-
-def verify_database_structure():
-    """Verify that all required tables exist"""
-    try:
-        db = get_db()
-        cursor = db.cursor()
-
-        # Check each table
-        required_tables = ['inventory', 'loans', 'loans_equipment', 'toner_inventory']
-        for table in required_tables:
-            cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
-            if not cursor.fetchone():
-                print(f"Table {table} is missing, creating tables...")
-                create_tables(db)
-                return
-
-        print("All required tables exist")
-    except Exception as e:
-        print(f"Error verifying database structure: {e}")
\ No newline at end of file
+        raise
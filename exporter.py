@@ -0,0 +1,179 @@
+import io
+import csv
+import json
+import hashlib
+import tempfile
+import threading
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+
+from importer import IMPORT_COLUMNS
+
+# Rows pulled from the cursor per round trip
+EXPORT_FETCH_SIZE = 1000
+
+# Exportable datasets: name -> (column headers, query)
+EXPORTS = {
+    'inventory': (
+        ['ID', 'Name', 'Quantity', 'Green Number', 'Category', 'Status', 'Created At'],
+        '''
+            SELECT id, name, quantity, green_number, category, status, created_at
+            FROM inventory
+            ORDER BY id
+        '''
+    ),
+    'loans': (
+        ['ID', 'Borrower', 'Item Name', 'Green Number', 'Loan Date', 'Due Date', 'Status'],
+        '''
+            SELECT loans.id, borrower_name, item_name, green_number, loan_date, due_date, status
+            FROM borrowers
+            CROSS JOIN loans ON loans.borrower_id = borrowers.id
+            WHERE status = 'active'
+            ORDER BY borrowers.name_key, loan_date DESC, loans.id DESC
+        '''
+    ),
+    'loans_history': (
+        ['ID', 'Borrower', 'Item Name', 'Green Number', 'Loan Date', 'Return Date', 'Status'],
+        '''
+            SELECT id, borrower_name, item_name, green_number, loan_date, return_date, status
+            FROM all_loans
+            WHERE status = 'returned'
+            ORDER BY id DESC
+        '''
+    ),
+    'toner': (
+        ['ID', 'Name', 'Printer', 'BK Toner', 'Color', 'Inventory', 'Created At'],
+        '''
+            SELECT id, name, printer, bk_toner, color, inventory, created_at
+            FROM toner_inventory
+            ORDER BY id DESC
+        '''
+    ),
+}
+
+
+def iter_export_rows(connection, dataset):
+    """Yield rows of a dataset straight off the cursor, a batch at a time"""
+    _, query = EXPORTS[dataset]
+    cursor = connection.execute(query)
+    while True:
+        rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            return
+        for row in rows:
+            yield tuple(row)
+
+
+def stream_csv(connection, dataset):
+    """Generate a CSV export as encoded chunks, one cursor batch per chunk"""
+    headers, _ = EXPORTS[dataset]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    # BOM so Excel opens UTF-8 (e.g. Hebrew names) correctly
+    buffer.write('\ufeff')
+    writer.writerow(headers)
+
+    for count, row in enumerate(iter_export_rows(connection, dataset), 1):
+        writer.writerow(row)
+        if count % EXPORT_FETCH_SIZE == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue().encode('utf-8')
+
+
+def build_xlsx(connection, dataset):
+    """
+    Write an .xlsx export with openpyxl's write-only mode
+
+    Rows go straight to the workbook's temporary XML as they are read, and the
+    finished file is spooled to a temp file, so memory stays bounded.
+
+    Returns:
+        file object positioned at the start of the workbook
+    """
+    headers, _ = EXPORTS[dataset]
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=dataset.replace('_', ' ').title())
+
+    bold = Font(bold=True)
+    header_row = []
+    for header in headers:
+        cell = WriteOnlyCell(sheet, value=header)
+        cell.font = bold
+        header_row.append(cell)
+    sheet.append(header_row)
+
+    for row in iter_export_rows(connection, dataset):
+        sheet.append(row)
+
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return output
+
+
+# Import template layout: (header, example value, column width)
+TEMPLATE_COLUMNS = list(zip(IMPORT_COLUMNS, ['Example Item', 5, 1001, 'Electronics', 'no'], [30, 10, 15, 20, 10]))
+
+_template_lock = threading.Lock()
+_template_cache = {}
+
+
+def build_import_template():
+    """Build the styled import template workbook and return it as bytes"""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Inventory Template"
+
+    # Style definitions
+    header_font = Font(bold=True, color="FFFFFF")
+    header_fill = PatternFill(start_color="2196F3", end_color="2196F3", fill_type="solid")
+    border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+
+    for col, (header, example, width) in enumerate(TEMPLATE_COLUMNS, 1):
+        cell = ws.cell(row=1, column=col, value=header)
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.border = border
+        cell.alignment = Alignment(horizontal='center')
+
+        cell = ws.cell(row=2, column=col, value=example)
+        cell.border = border
+        cell.alignment = Alignment(horizontal='center')
+
+        ws.column_dimensions[cell.column_letter].width = width
+
+    output = io.BytesIO()
+    wb.save(output)
+    return output.getvalue()
+
+
+def get_import_template():
+    """
+    Return the import template as (etag, bytes)
+
+    The workbook is built once per header definition and kept in memory, so
+    downloads don't rebuild it or race on a file on disk.
+    """
+    key = hashlib.sha256(json.dumps(TEMPLATE_COLUMNS).encode('utf-8')).hexdigest()
+    cached = _template_cache.get(key)
+    if cached is None:
+        with _template_lock:
+            cached = _template_cache.get(key)
+            if cached is None:
+                # Keyed on the definition only: the workbook embeds its creation
+                # time, so hashing the bytes would change the ETag every restart
+                cached = (key[:32], build_import_template())
+                _template_cache.clear()
+                _template_cache[key] = cached
+    return cached
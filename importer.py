@@ -0,0 +1,199 @@
+import os
+import csv
+import json
+import logging
+from itertools import islice
+
+import pandas as pd
+from openpyxl import load_workbook
+
+from database import ensure_unique_green_numbers
+
+logger = logging.getLogger(__name__)
+
+IMPORT_COLUMNS = ['name', 'quantity', 'green_number', 'category', 'status']
+
+# Rows read, validated and committed together by streaming imports
+IMPORT_CHUNK_SIZE = 5000
+
+# Spreadsheet rows start at 2, row 1 holds the headers
+FIRST_DATA_ROW = 2
+
+# Rejected rows kept on a job for the report, the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+
+UPSERT_INVENTORY = '''
+    INSERT INTO inventory (name, quantity, green_number, category, status)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(green_number) DO UPDATE SET
+        name = excluded.name,
+        quantity = excluded.quantity,
+        category = excluded.category,
+        status = excluded.status
+'''
+
+
+def missing_columns(headers):
+    """Return the required import columns the sheet does not have"""
+    return [column for column in IMPORT_COLUMNS if column not in headers]
+
+
+def prepare_import_frame(df, first_row=FIRST_DATA_ROW):
+    """
+    Validate and coerce a whole sheet at once
+
+    Args:
+        df: DataFrame read from the uploaded sheet, indexed by data row offset
+        first_row: Spreadsheet row number of data row 0, used in the report
+
+    Returns:
+        tuple: (DataFrame of clean rows in IMPORT_COLUMNS order,
+                list of {'row': n, 'errors': [...]} for rejected rows)
+    """
+    name = df['name'].astype('string').str.strip()
+    category = df['category'].astype('string').str.strip()
+    quantity = pd.to_numeric(df['quantity'], errors='coerce')
+    green_number = pd.to_numeric(df['green_number'], errors='coerce')
+    # CSV leaves a blank status as '' where Excel gives NaN, both mean 'no'
+    status = df['status'].astype('string').str.strip().str.lower()
+    status = status.mask(status == '').fillna('no')
+
+    checks = [
+        (name.isna() | (name == ''), 'name is required'),
+        (category.isna() | (category == ''), 'category is required'),
+        (quantity.isna() | (quantity % 1 != 0) | (quantity < 0), 'quantity must be a whole number of 0 or more'),
+        (green_number.isna() | (green_number % 1 != 0), 'green_number must be a whole number'),
+        (~status.isin(['yes', 'no']), "status must be 'yes' or 'no'"),
+    ]
+
+    invalid = pd.Series(False, index=df.index)
+    messages = {}
+    for mask, message in checks:
+        mask = mask.fillna(True).astype(bool)
+        invalid |= mask
+        for offset in df.index[mask.to_numpy()]:
+            messages.setdefault(int(offset), []).append(message)
+
+    errors = [{'row': first_row + offset, 'errors': row_errors}
+              for offset, row_errors in sorted(messages.items())]
+
+    valid = ~invalid
+    clean = pd.DataFrame({
+        'name': name[valid].astype(object),
+        'quantity': quantity[valid].astype('int64'),
+        'green_number': green_number[valid].astype('int64'),
+        'category': category[valid].astype(object),
+        'status': status[valid].astype(object),
+    }, columns=IMPORT_COLUMNS)
+    return clean, errors
+
+
+def read_rows(path):
+    """
+    Open an upload for streaming
+
+    .xlsx is read with openpyxl in read-only mode and .csv with the csv module,
+    so only the current row is held in memory. Legacy .xls can't be streamed
+    and is loaded with pandas (the format caps out at 65536 rows anyway).
+
+    Returns:
+        tuple: (header names, iterator of row value tuples)
+    """
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == '.csv':
+        handle = open(path, newline='', encoding='utf-8-sig')
+        reader = csv.reader(handle)
+        headers = next(reader, [])
+
+        def csv_rows():
+            with handle:
+                yield from reader
+        return [str(header).strip() for header in headers], csv_rows()
+
+    if extension == '.xlsx':
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        headers = next(rows, ())
+
+        def sheet_rows():
+            try:
+                yield from rows
+            finally:
+                workbook.close()
+        return [str(header).strip() if header is not None else '' for header in headers], sheet_rows()
+
+    df = pd.read_excel(path)
+    return [str(column).strip() for column in df.columns], df.itertuples(index=False, name=None)
+
+
+def iter_chunks(headers, rows, chunk_size=IMPORT_CHUNK_SIZE, skip=0):
+    """
+    Yield (rows consumed, DataFrame) chunks, skipping rows already processed
+
+    Each DataFrame is indexed by data row offset so reports keep the real row
+    numbers. Blank rows are dropped but still counted as consumed.
+    """
+    offset = skip
+    rows = iter(rows)
+    # Fast-forward past the checkpoint of a resumed job
+    for _ in islice(rows, skip):
+        pass
+
+    while True:
+        batch = list(islice(rows, chunk_size))
+        if not batch:
+            return
+        width = len(headers)
+        records = {}
+        for position, row in enumerate(batch):
+            values = (tuple(row) + (None,) * width)[:width]
+            if any(value not in (None, '') for value in values):
+                records[offset + position] = values
+        chunk = pd.DataFrame.from_dict(records, orient='index', columns=headers) if records \
+            else pd.DataFrame(columns=headers)
+        offset += len(batch)
+        yield len(batch), chunk
+
+
+def run_import_job(connection, job, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Stream an uploaded file into inventory chunk by chunk
+
+    Each chunk's rows and the job checkpoint are committed together, so a job
+    that dies part way resumes from the last committed chunk when run again.
+    """
+    job_id = job['id']
+    errors = json.loads(job['errors'])
+
+    headers, rows = read_rows(job['file_path'])
+    missing = missing_columns(headers)
+    if missing:
+        raise ValueError(f"File must contain columns: {', '.join(IMPORT_COLUMNS)} (missing {', '.join(missing)})")
+
+    # Rows are upserted on green_number, which needs the unique index
+    if not ensure_unique_green_numbers(connection):
+        raise ValueError('Some green numbers are used by more than one item. '
+                         'Resolve the duplicates listed on the inventory page, then import the file again.')
+
+    cursor = connection.cursor()
+    for consumed, chunk in iter_chunks(headers, rows, chunk_size, skip=job['rows_processed']):
+        clean, chunk_errors = prepare_import_frame(chunk)
+        cursor.executemany(UPSERT_INVENTORY, list(clean.itertuples(index=False, name=None)))
+        errors.extend(chunk_errors[:max(0, MAX_REPORTED_ERRORS - len(errors))])
+        cursor.execute('''
+            UPDATE jobs
+            SET rows_processed = rows_processed + ?,
+                rows_imported = rows_imported + ?,
+                error_count = error_count + ?,
+                errors = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (consumed, len(clean), len(chunk_errors), json.dumps(errors), job_id))
+        connection.commit()
+
+    # The upload is only kept around for resuming
+    try:
+        os.remove(job['file_path'])
+    except OSError:
+        pass
@@ -0,0 +1,117 @@
+"""
+Index advisor
+
+Runs EXPLAIN QUERY PLAN over every SQL statement written in the application
+modules, against an empty database at the latest schema version, and reports
+the statements that scan a whole table or sort in a temporary B-tree.
+
+Usage: python index_advisor.py [module.py ...]
+"""
+import ast
+import re
+import sys
+import sqlite3
+
+import database
+from database import apply_migrations, attach_archive
+
+DEFAULT_MODULES = ['app.py', 'database.py', 'exporter.py', 'importer.py', 'jobs.py', 'policies.py']
+
+SQL_START = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+MISSING_BINDINGS = re.compile(r'uses (\d+), and there are')
+
+# Plan steps worth a look: full table scans and sorts that can't use an index
+FLAGGED_STEPS = re.compile(r'^(SCAN (?!CONSTANT ROW)(?!.*VIRTUAL TABLE)|USE TEMP B-TREE)')
+
+# Stand-ins for f-string placeholders that aren't module constants in database.py
+SAMPLE_VALUES = {
+    'columns': '*',
+    'source': 'inventory',
+    'sort_field': 'id',
+    'sort_direction': 'DESC',
+    'order': 'DESC',
+    'where_clause': "WHERE status = 'active'",
+}
+
+
+def sql_strings(path):
+    """
+    Yield (line number, SQL text) for every string literal in a module that holds SQL
+
+    f-string placeholders are filled from SAMPLE_VALUES or the constants of
+    database.py, anything else is left empty (which keeps optional clauses such
+    as {where_clause} valid). Statements that still don't parse are reported
+    as not planned.
+    """
+    with open(path, encoding='utf-8') as handle:
+        tree = ast.parse(handle.read(), filename=path)
+
+    # The literal pieces of f-strings are visited on their own too, skip them
+    fragments = {id(part) for node in ast.walk(tree) if isinstance(node, ast.JoinedStr) for part in node.values}
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) and id(node) not in fragments:
+            # Templates filled in later with str.format
+            text = re.sub(r'\{(\w+)\}', lambda match: placeholder(ast.Name(match.group(1))), node.value)
+        elif isinstance(node, ast.JoinedStr):
+            text = ''.join(part.value if isinstance(part, ast.Constant) else placeholder(part.value)
+                           for part in node.values)
+        else:
+            continue
+        if SQL_START.match(text) and ('FROM' in text.upper() or 'INTO' in text.upper() or 'SET' in text.upper()):
+            yield node.lineno, text
+
+
+def placeholder(expression):
+    """Sample text for an f-string placeholder"""
+    name = ast.unparse(expression)
+    if name in SAMPLE_VALUES:
+        return SAMPLE_VALUES[name]
+    value = getattr(database, name, None)
+    return str(value) if isinstance(value, (str, int)) else ''
+
+
+def explain(connection, sql):
+    """Return the plan steps of a statement, binding NULL to every parameter"""
+    bindings = []
+    for _ in range(2):
+        try:
+            rows = connection.execute(f'EXPLAIN QUERY PLAN {sql}', bindings).fetchall()
+            return [row[3] for row in rows]
+        except sqlite3.ProgrammingError as e:
+            match = MISSING_BINDINGS.search(str(e))
+            if not match:
+                raise
+            bindings = [None] * int(match.group(1))
+
+
+def main(modules):
+    connection = sqlite3.connect(':memory:')
+    apply_migrations(connection)
+    attach_archive(connection, ':memory:')
+
+    flagged = unplanned = total = 0
+    for module in modules:
+        for lineno, sql in sql_strings(module):
+            total += 1
+            summary = ' '.join(sql.split())[:100]
+            try:
+                steps = explain(connection, sql)
+            except sqlite3.Error as e:
+                unplanned += 1
+                print(f'{module}:{lineno}: not planned ({e}): {summary}')
+                continue
+
+            problems = [step for step in steps if FLAGGED_STEPS.match(step)]
+            if problems:
+                flagged += 1
+                print(f'{module}:{lineno}: {summary}')
+                for step in problems:
+                    print(f'    {step}')
+
+    print(f'{total} statements, {flagged} with scans or temp B-trees, {unplanned} not planned')
+    return 1 if flagged else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:] or DEFAULT_MODULES))
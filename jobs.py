@@ -0,0 +1,177 @@
+import os
+import json
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from database import get_db
+
+logger = logging.getLogger(__name__)
+
+JOB_COLUMNS = ('filename', 'file_path')
+
+# Finished jobs, and the uploads they still hold, are deleted after this long
+JOB_RETENTION_DAYS = 30
+
+
+class JobQueue:
+    """
+    In-process background jobs backed by the jobs table
+
+    Handlers run on a small thread pool inside an app context, so they can use
+    get_db() like a view. Progress and results live in the jobs table, which
+    lets requests return straight away and poll for the outcome.
+    """
+
+    def __init__(self, max_workers=2):
+        self.max_workers = max_workers
+        self.app = None
+        self._handlers = {}
+        self._executor = None
+
+    def init_app(self, app):
+        self.app = app
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+
+    def handler(self, kind, enqueue_from_web=False):
+        """
+        Register the function that runs jobs of a kind
+
+        The function receives (connection, job row) and may return a JSON
+        serialisable result. Kinds that take no input can be allowed to be
+        started through the generic enqueue endpoint.
+        """
+        def register(function):
+            self._handlers[kind] = (function, enqueue_from_web)
+            return function
+        return register
+
+    def can_enqueue_from_web(self, kind):
+        return kind in self._handlers and self._handlers[kind][1]
+
+    def enqueue(self, kind, **columns):
+        """Record a pending job and start it in the background, returning its id"""
+        if kind not in self._handlers:
+            raise ValueError(f'Unknown job kind: {kind}')
+
+        unknown = set(columns) - set(JOB_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown job columns: {', '.join(sorted(unknown))}")
+
+        job_id = uuid.uuid4().hex
+        names = ['id', 'kind'] + list(columns)
+        db = get_db()
+        db.execute(
+            f"INSERT INTO jobs ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+            [job_id, kind] + list(columns.values())
+        )
+        db.commit()
+
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def resume(self, job_id):
+        """Start a failed job again; handlers pick up from their own checkpoint"""
+        db = get_db()
+        job = get_job(db, job_id)
+        if job is None or not is_resumable(job):
+            return False
+        cursor = db.execute(
+            "UPDATE jobs SET status = 'pending', message = NULL, updated_at = CURRENT_TIMESTAMP "
+            "WHERE id = ? AND status = 'failed'", (job_id,))
+        db.commit()
+        if cursor.rowcount:
+            self._executor.submit(self._run, job_id)
+        return bool(cursor.rowcount)
+
+    def recover_interrupted(self, retention_days=JOB_RETENTION_DAYS):
+        """
+        Mark jobs cut off by a restart as failed so they can be resumed, and
+        delete jobs that finished more than retention_days ago with their uploads
+        """
+        db = get_db()
+        cursor = db.execute(
+            "UPDATE jobs SET status = 'failed', message = 'Interrupted by a restart', "
+            "updated_at = CURRENT_TIMESTAMP WHERE status IN ('pending', 'running')")
+        db.commit()
+        if cursor.rowcount:
+            logger.warning(f"Marked {cursor.rowcount} interrupted jobs as failed")
+
+        cursor = db.execute(
+            "SELECT id, file_path FROM jobs WHERE status IN ('completed', 'failed') "
+            "AND updated_at < datetime('now', ?)", (f'-{retention_days} days',))
+        expired = cursor.fetchall()
+        for job in expired:
+            remove_upload(job['file_path'])
+        db.execute('DELETE FROM jobs WHERE id IN (SELECT value FROM json_each(?))',
+                   (json.dumps([job['id'] for job in expired]),))
+        db.commit()
+        if expired:
+            logger.info(f"Deleted {len(expired)} jobs finished more than {retention_days} days ago")
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            db = get_db()
+            job = get_job(db, job_id)
+            function, _ = self._handlers[job['kind']]
+
+            db.execute(
+                "UPDATE jobs SET status = 'running', updated_at = CURRENT_TIMESTAMP WHERE id = ?", (job_id,))
+            db.commit()
+
+            try:
+                result = function(db, job)
+            except Exception as e:
+                logger.error(f"Job {job_id} ({job['kind']}) failed: {str(e)}", exc_info=True)
+                db.rollback()
+                # The handler gave up on this input, it would only fail the same way again
+                remove_upload(job['file_path'])
+                db.execute(
+                    "UPDATE jobs SET status = 'failed', message = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (str(e), job_id))
+                db.commit()
+                return
+
+            db.execute(
+                "UPDATE jobs SET status = 'completed', result = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (json.dumps(result) if result is not None else None, job_id))
+            db.commit()
+
+
+def get_job(connection, job_id):
+    cursor = connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+    return cursor.fetchone()
+
+
+def remove_upload(file_path):
+    if file_path:
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+
+def is_resumable(job):
+    """Failed jobs can be run again while the upload they read from, if any, is still there"""
+    return job['status'] == 'failed' and (not job['file_path'] or os.path.exists(job['file_path']))
+
+
+def job_to_dict(job):
+    """Progress and outcome of a job as returned by the polling endpoint"""
+    return {
+        'id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'filename': job['filename'],
+        'rows_processed': job['rows_processed'],
+        'rows_imported': job['rows_imported'],
+        'error_count': job['error_count'],
+        'message': job['message'],
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+        'result': json.loads(job['result']) if job['result'] else None,
+        'resumable': is_resumable(job),
+    }
+
+
+job_queue = JobQueue()
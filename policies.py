@@ -0,0 +1,55 @@
+from collections import namedtuple
+
+from cache import cache
+
+# Policy row that applies to categories without one of their own
+DEFAULT_CATEGORY = '*'
+
+LoanPolicy = namedtuple('LoanPolicy', ['category', 'loan_days', 'extension_days', 'max_extensions'])
+
+
+def load_policies(connection):
+    """
+    Return all loan policies as {category: LoanPolicy}
+
+    Policies change rarely, so they are read once and kept in the shared cache
+    until invalidate_policies() is called after an edit.
+    """
+    def load():
+        cursor = connection.execute('SELECT category, loan_days, extension_days, max_extensions FROM loan_policies')
+        return {row[0]: LoanPolicy(*row) for row in cursor.fetchall()}
+    return cache.get('loan_policies', ('loan_policies',), load)
+
+
+def invalidate_policies():
+    cache.bump('loan_policies')
+
+
+def policy_for(connection, category):
+    """Return the policy of a category, falling back to the default one"""
+    policies = load_policies(connection)
+    return policies.get(category) or policies[DEFAULT_CATEGORY]
+
+
+def save_policy(connection, category, loan_days, extension_days, max_extensions):
+    """Create or update the policy of a category; new loans pick it up straight away"""
+    connection.execute('''
+        INSERT INTO loan_policies (category, loan_days, extension_days, max_extensions)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(category) DO UPDATE SET
+            loan_days = excluded.loan_days,
+            extension_days = excluded.extension_days,
+            max_extensions = excluded.max_extensions,
+            updated_at = CURRENT_TIMESTAMP
+    ''', (category, loan_days, extension_days, max_extensions))
+    connection.commit()
+    invalidate_policies()
+
+
+def delete_policy(connection, category):
+    """Remove a category's policy so it falls back to the default; the default itself stays"""
+    if category == DEFAULT_CATEGORY:
+        raise ValueError('The default policy cannot be deleted')
+    connection.execute('DELETE FROM loan_policies WHERE category = ?', (category,))
+    connection.commit()
+    invalidate_policies()
@@ -0,0 +1,96 @@
+"""
+Response compression and conditional GET for the app's own pages
+
+compress_response() gzips (or brotlis) HTML and JSON bodies above a size
+threshold. @conditional_page() gives a read-only page a weak ETag made from
+the change counters of the tables it shows, so a repeat load of an unchanged
+page is answered with an empty 304 without running the view at all.
+"""
+import functools
+import gzip
+import hashlib
+import uuid
+from datetime import date
+
+from flask import Response, make_response, request, session
+from werkzeug.http import is_resource_modified
+
+from assets import COMPRESSIBLE_TYPES, brotli
+from cache import cache
+
+# Bodies smaller than this go out as they are
+COMPRESS_MIN_SIZE = 1024
+
+# Table versions count from zero in every process, so ETags also carry the process they came from
+BOOT_ID = uuid.uuid4().hex
+
+
+def compress_response(response):
+    """after_request hook: compress buffered text responses the client accepts compressed"""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or not response.mimetype
+            or not response.mimetype.startswith(COMPRESSIBLE_TYPES)):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if brotli is not None and request.accept_encodings['br']:
+        encoding = 'br'
+    elif request.accept_encodings['gzip']:
+        encoding = 'gzip'
+    else:
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    # Fast settings, these bodies are compressed on every request
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=5))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=6))
+    response.content_encoding = encoding
+
+    # A strong ETag names exact bytes, which the encoded body no longer are
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def page_etag(tables):
+    """Validator of the current request's page given the versions of the tables it reads"""
+    # Overdue flags change with the date even when no table does
+    key = [BOOT_ID, request.full_path, date.today().isoformat()]
+    key += [f'{table}={cache.version(table)}' for table in tables]
+    return hashlib.sha256('|'.join(key).encode()).hexdigest()[:32]
+
+
+def conditional_page(*tables):
+    """
+    Serve a read-only page with a weak ETag built from its tables' change counters
+
+    Repeat GETs carrying the ETag get a 304 while no write path has bumped one
+    of the tables. Requests with pending flash messages always render, since
+    the messages are part of the page.
+    """
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            # Taken before rendering, so a write during the view leaves the ETag behind, never ahead
+            etag = page_etag(tables)
+            if not is_resource_modified(request.environ, etag=etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorate
@@ -4,7 +4,7 @@ from license_validator import LicenseValidator
 import sys
 import webbrowser
 from threading import Thread
-from app import app
+from app import app, init_app
 import time
 import socket
 
@@ -95,6 +95,7 @@ def validate_license():
 
 def start_flask(port):
     try:
+        init_app()
         app.run(host='0.0.0.0', port=port, threaded=True)
     except Exception as e:
         print(f"Error starting Flask: {e}")
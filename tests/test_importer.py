@@ -0,0 +1,23 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from importer import iter_chunks, prepare_import_frame, read_rows
+
+
+def test_blank_csv_status_imports_as_no(tmp_path):
+    path = tmp_path / 'inventory.csv'
+    path.write_text(
+        'name,quantity,green_number,category,status\n'
+        'Laptop,2,1001,Computers,\n'
+        'Mouse,5,1002,Accessories,  \n'
+        'Cable,3,1003,Accessories,YES\n',
+        encoding='utf-8')
+
+    headers, rows = read_rows(str(path))
+    _, chunk = next(iter_chunks(headers, rows))
+    clean, errors = prepare_import_frame(chunk)
+
+    assert errors == []
+    assert list(clean['status']) == ['no', 'no', 'yes']